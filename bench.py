@@ -0,0 +1,194 @@
+#======================================================================
+# GDDB: Graphical Datalog Debugger
+# Author: Jade Koskela <jtkoskela@ucdavis.edu>
+# http://github.com/jkoskela/gddb
+# Benchmarks for GDDB
+#======================================================================
+"""
+End to end benchmarks on generated Datalog programs.
+Each workload is generated at a given scale, then run through the phases of a gddb session:
+parsing the rules, evaluation, build, indexing the atoms, trace and draw. The parser rewrites every rule into aux
+rules as it reads it, so parse includes the rewrite. The rewrite phase times it on its own:
+making the aux rules and rule map of the parsed rules, and the aux program given to dlv.
+Every phase records its wall time and memory, written as JSON so runs of different versions
+can be compared.
+
+Usage: python bench.py [-s scale] [-w workload,...] [-t traces] [-j processes] [-g] [-o out.json]
+  -s  scale factor for the workloads, default 1
+  -w  comma separated workloads, default all of chain,grid,random,join,negation
+  -t  atoms traced in the trace phase, default 10
+  -j  processes of the build phase, default 1
+  -g  run graphviz in the draw phase, instead of only writing the DOT text
+  -o  output file, default stdout
+
+Python 2 has no tracemalloc, so memory is measured for the process. rss_delta_kb is how much the
+RSS grew during the phase, rss_kb the RSS after it. process_max_rss_kb is the high-water mark of the
+process so far, not of the phase: it only shows a phase's peak when that exceeds every earlier one.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import getopt
+import resource
+import tempfile
+import platform
+import parsedlv
+from rule import Rule
+import evaldlv
+import graphdlv
+
+tc_rules = ('tc(X,Y) :- e(X,Y).\n'
+            'tc(X,Y) :- e(X,Z), tc(Z,Y).\n')
+
+def chain(n):
+   """ Transitive closure of a chain of n nodes. """
+   return tc_rules, [('e', (str(i), str(i + 1))) for i in xrange(n - 1)]
+
+def grid(n):
+   """ Transitive closure of an n by n grid, edges go right and down. """
+   node = lambda i, j: '%d_%d' % (i, j)
+   facts = []
+   for i in xrange(n):
+      for j in xrange(n):
+         if j + 1 < n: facts.append(('e', (node(i, j), node(i, j + 1))))
+         if i + 1 < n: facts.append(('e', (node(i, j), node(i + 1, j))))
+   return tc_rules, facts
+
+def random_graph(n, m, seed=0):
+   """ Transitive closure of a random graph with n nodes and m edges. """
+   rnd = random.Random(seed)
+   edges = set()
+   while len(edges) < m:
+      edges.add((str(rnd.randrange(n)), str(rnd.randrange(n))))
+   return tc_rules, [('e', e) for e in sorted(edges)]
+
+def join(n, width):
+   """ Star join of width relations over n keys, each key has two values in every relation. """
+   body = ', '.join('r%d(X,Y%d)' % (i, i) for i in xrange(width))
+   head = 'j(X,%s)' % ','.join('Y%d' % i for i in xrange(width))
+   facts = [('r%d' % i, (str(k), str(k * 2 + v))) for i in xrange(width) for k in xrange(n) for v in xrange(2)]
+   return '%s :- %s.\n' % (head, body), facts
+
+def negation(n, courses, seed=0):
+   """ The program of student_rules.dlv, with n students taking random courses. """
+   rules = ('out(P) :- p(P), cl(C), not se(P,C).\n'
+            'p(P) :- se(P,Z).\n'
+            'r(P) :- se(P,Z), not out(P).\n'
+            'late(P) :- out(P), not r(P).\n')
+   rnd = random.Random(seed)
+   facts = [('cl', (str(c),)) for c in xrange(courses)]
+   for s in xrange(n):
+      taken = range(courses) if rnd.random() < 0.2 else rnd.sample(xrange(courses), rnd.randint(1, courses))
+      facts.extend(('se', ('s%d' % s, str(c))) for c in sorted(taken))
+   return rules, facts
+
+def workloads(scale):
+   """ Returns (name, parameters, generator) of every workload at scale. """
+   s = max(scale, 0.01)
+   return [('chain', {'n': int(200 * s)}, chain),
+           ('grid', {'n': int(12 * s ** 0.5)}, grid),
+           ('random', {'n': int(150 * s), 'm': int(300 * s)}, random_graph),
+           ('join', {'n': int(500 * s), 'width': 6}, join),
+           ('negation', {'n': int(2000 * s), 'courses': 8}, negation)]
+
+
+def rss():
+   """ Current resident set size in KB, None where /proc is not available. """
+   try:
+      return int(open('/proc/self/statm').read().split()[1]) * resource.getpagesize() // 1024
+   except (IOError, IndexError, ValueError):
+      return None
+
+def max_rss():
+   """ Largest resident set size the process has had so far, in KB. """
+   peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+   return peak // 1024 if sys.platform == 'darwin' else peak
+
+class Phases(object):
+   """ Records wall time and memory of the phases of one workload. """
+   def __init__(self, name, params):
+      self.name, self.params = name, params
+      self.results = []
+
+   def run(self, phase, f, *args):
+      """ Runs f(*args) as phase. Returns its result. """
+      before = rss()
+      start = time.time()
+      result = f(*args)
+      seconds = time.time() - start
+      after = rss()
+      self.results.append({'workload': self.name, 'params': self.params, 'phase': phase,
+                           'seconds': round(seconds, 6), 'rss_kb': after, 'process_max_rss_kb': max_rss(),
+                           'rss_delta_kb': None if before is None else after - before})
+      return result
+
+def rewrite(rules):
+   """ Rewrites parsed rules into aux rules as the parser does. Returns the rule map and the aux program. """
+   aux_rules = [Rule(r.head, r.body, i) for i, r in enumerate(rules)]
+   return parsedlv.rule_map_of(aux_rules), '\n'.join(map(str, aux_rules))
+
+def run_workload(name, params, gen, tmp, traces, processes, graphviz):
+   rules_text, facts = gen(**params)
+   rules_file, facts_file = os.path.join(tmp, name + '.dlv'), os.path.join(tmp, name + '-facts.dlv')
+   open(rules_file, 'w').write(rules_text)
+   open(facts_file, 'w').write(''.join('%s(%s).\n' % (p, ','.join(a)) for p, a in facts))
+
+   p = Phases(name, params)
+   rules, rule_map = p.run('parse', lambda: parsedlv.parse(open(rules_file).read()))
+   p.run('rewrite', rewrite, rules)
+   model = p.run('evaluate', lambda: list(evaldlv.Evaluator(rules, evaldlv.read_facts(facts_file)).run()))
+   graph, adj_list = p.run('build', graphdlv.build, rule_map, model, processes, False)
+   adj_list.index = p.run('index', graphdlv.AtomIndex, adj_list.atoms)
+
+   names = [a for a in adj_list if not a.startswith('aux') and not a.startswith('{')]
+   sample = random.Random(0).sample(names, min(traces, len(names)))
+   cache = graphdlv.TraceCache()
+   provenance = graphdlv.Negations(adj_list, adj_list.index)     #As GraphCMD.provenance traces
+   p.run('trace', lambda: [graphdlv.trace(provenance, a, cache) for a in sample])
+
+   styles = graphdlv.read_styles(None)
+   if graphviz:
+      f_out = os.path.join(tmp, name + '.pdf')
+      p.run('draw', graphdlv.render, graph, styles, 'dot', 'pdf', f_out)
+   else:
+      f_out = open(os.devnull, 'w')
+      p.run('draw', graphdlv.write_dot, f_out, graph, styles)
+      f_out.close()
+
+   size = {'aux_tuples': len(model), 'atoms': len(adj_list),
+           'edges': sum(len(subg['edges']) for subg in graph.itervalues())}
+   for r in p.results: r['size'] = size
+   return p.results
+
+if __name__ == '__main__':
+   try:
+      opts, args = getopt.getopt(sys.argv[1:], 's:w:t:j:go:')
+      opts = dict(opts)
+      scale = float(opts.get('-s', 1))
+      traces = int(opts.get('-t', 10))
+      processes = int(opts.get('-j', 1))
+   except (getopt.GetoptError, ValueError):
+      print __doc__
+      sys.exit(1)
+   chosen = opts.get('-w')
+   chosen = chosen.split(',') if chosen else None
+
+   tmp = tempfile.mkdtemp(prefix='gddb-bench')
+   results = []
+   try:
+      for name, params, gen in workloads(scale):
+         if chosen and name not in chosen: continue
+         sys.stderr.write('%s %s\n' % (name, params))
+         results.extend(run_workload(name, params, gen, tmp, traces, processes, '-g' in opts))
+   finally:
+      shutil.rmtree(tmp)
+
+   report = {'python': platform.python_version(), 'platform': platform.platform(),
+             'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'scale': scale, 'results': results}
+   out = open(opts['-o'], 'w') if '-o' in opts else sys.stdout
+   json.dump(report, out, indent=1, sort_keys=True)
+   out.write('\n')
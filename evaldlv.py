@@ -0,0 +1,432 @@
+#======================================================================
+# GDDB: Graphical Datalog Debugger
+# Author: Jade Koskela <jtkoskela@ucdavis.edu>
+# http://github.com/jkoskela/gddb
+# In-process Datalog evaluator for GDDB
+#======================================================================
+"""
+Semi-naive bottom-up evaluation of Datalog with stratified negation.
+Evaluates the Rule objects created by parsedlv and yields the aux tuples of the model directly,
+so graphdlv.build can run without dlv and without the intermediate dlv_aux_rules/dlv_out files.
+With a goal, only the rules the goal depends on are evaluated, rewritten with magic sets so the
+bound arguments of the goal restrict which tuples are derived. See demand().
+"""
+
+import re
+from copy import copy
+from collections import defaultdict
+from itertools import izip, chain
+
+fact_re = re.compile('([_A-Za-z0-9]+)\(([^)]*)\)\s*\.')
+
+def read_facts(f_in):
+   """ Generator over the facts in file f_in. Yields (predicate, args) pairs, eg. ('e', ('1','2')). """
+   for line in open(f_in):
+      line = line.split('%')[0]      #Strip comments
+      for m in fact_re.finditer(line):
+         yield m.group(1), tuple(a.strip() for a in m.group(2).split(','))
+
+
+def is_var(term):
+   """ Variables start with an upper case letter or an underscore, everything else is a constant. """
+   return term[0].isupper() or term[0] == '_'
+
+
+def unify(terms, t):
+   """ Returns the binding of variables that makes an atom with terms equal to tuple t, None if there is none. """
+   binding = {}
+   for term, value in izip(terms, t):
+      if is_var(term):
+         if binding.setdefault(term, value) != value: return None
+      elif term != value:
+         return None
+   return binding
+
+
+class Relation(object):
+   """ Tuples of one predicate, with hash indexes on the columns joins look them up by. """
+   def __init__(self, tuples=()):
+      self.tuples = set(tuples)
+      self.indexes = {}       #Columns -> {values in those columns: set of tuples}
+
+   def add(self, t):
+      self.tuples.add(t)
+      for cols, index in self.indexes.iteritems():
+         index.setdefault(tuple([t[c] for c in cols]), set()).add(t)
+
+   def remove(self, t):
+      self.tuples.discard(t)
+      for cols, index in self.indexes.iteritems():
+         key = tuple([t[c] for c in cols])
+         bucket = index.get(key)
+         if bucket:
+            bucket.discard(t)
+            if not bucket: del index[key]
+
+   def lookup(self, cols, key):
+      """ Returns the tuples whose values in columns cols are key. """
+      if not cols: return self.tuples
+      index = self.indexes.get(cols)
+      if index is None:
+         index = self.indexes[cols] = {}
+         for t in self.tuples:
+            index.setdefault(tuple([t[c] for c in cols]), set()).add(t)
+      return index.get(key, ())
+
+   def __contains__(self, t):
+      return t in self.tuples
+
+   def __len__(self):
+      return len(self.tuples)
+
+
+class Clause(object):
+   """
+   A Rule compiled for evaluation.
+   head and body atoms are (predicate, terms) pairs, neg holds the negated body atoms.
+   aux_args are the terms of the aux atom in the order of its arguments, aux_pos their positions.
+   hidden clauses, the magic rules of demand(), record their aux tuples but do not report them.
+   """
+   def __init__(self, rule):
+      self.hidden = False
+      self.aux_pred = rule.aux_pred
+      self.aux_args = sorted(rule.arg_map, key=rule.arg_map.get)
+      self.aux_pos = dict(rule.arg_map)
+      self.head = (rule.head.predicate, rule.head.args_list)
+      self.body, self.neg = [], []
+      for atom in rule.body:
+         n = re.match('not (.+)', atom.predicate)
+         if n:
+            self.neg.append((n.group(1), atom.args_list))
+         else:
+            self.body.append((atom.predicate, atom.args_list))
+
+   def aux_key(self, terms, t):
+      """
+      Returns (columns, values) selecting the aux tuples in which the atom with terms is tuple t,
+      for Relation.lookup. None if the atom can never be t.
+      """
+      binding = unify(terms, t)
+      if binding is None: return None
+      cols = tuple(sorted(self.aux_pos[v] for v in binding))
+      return cols, tuple([binding[self.aux_args[i]] for i in cols])
+
+   def head_of(self, aux):
+      """ Returns the head tuple derived by aux tuple aux. """
+      return tuple([aux[self.aux_pos[t]] for t in self.head[1]])
+
+
+class Evaluator(object):
+   """
+   Semi-naive evaluation of a stratified Datalog program, with incremental maintenance of the model.
+   rules - Rule objects, as returned by parsedlv.parse
+   facts - (predicate, args) pairs, eg. from read_facts
+   goal  - (predicate, terms) of a goal atom such as ('r', ['P']), terms may be None. Evaluates only
+           what the goal needs, see demand(). The aux tuples are a subset of those of the full model
+           that contains every one the goal depends on. Unbound body atoms may pull in more, other
+           predicates may be incomplete.
+   db holds the model and edb the input facts, one Relation/set per predicate.
+   aux holds the aux tuples, one Relation per rule. They record every derivation, which is what
+   lets update() find the derivations of a tuple without joining.
+   """
+   def __init__(self, rules, facts, goal=None):
+      self.clauses = [Clause(r) for r in rules]
+      seeds = []
+      if goal:
+         self.clauses, seeds = demand(self.clauses, *goal)
+      self.strata = stratify(self.clauses)
+      self.db = defaultdict(Relation)
+      self.edb = defaultdict(set)
+      self.aux = defaultdict(Relation)
+      self.heads = defaultdict(list)       #Predicate -> clauses deriving it
+      self.users = []                      #Per stratum: predicate -> [(clause, terms)] of positive, negated body atoms
+      for c in self.clauses:
+         self.heads[c.head[0]].append(c)
+      for stratum in self.strata:
+         pos, neg = defaultdict(list), defaultdict(list)
+         for c in stratum:
+            for pred, terms in c.body: pos[pred].append((c, terms))
+            for pred, terms in c.neg: neg[pred].append((c, terms))
+         self.users.append((pos, neg))
+      for pred, args in chain(facts, seeds):
+         self.edb[pred].add(args)
+         self.db[pred].add(args)
+
+   def run(self):
+      """
+      Evaluates the program to fixpoint, stratum by stratum.
+      Generator over the aux tuples of the model, as (aux predicate, args) pairs like graphdlv.read_aux.
+      """
+      for stratum in self.strata:
+         new = defaultdict(set)
+         for c in stratum:                    #First round joins the full relations
+            for pred, aux in self.fire(c, self.plans(c, None), new):
+               yield pred, ','.join(aux)
+         for pred, aux in self.saturate(stratum, new):
+            yield pred, ','.join(aux)
+
+   def saturate(self, stratum, new, plus=None):
+      """
+      Adds the head tuples in new to the model, then applies stratum semi-naively, with the tuples
+      of the previous round as delta, until nothing new is derived. Records added tuples in plus.
+      Generator over the new aux tuples.
+      """
+      while new:
+         delta = {}
+         for pred, tuples in new.iteritems():
+            for t in tuples:
+               self.db[pred].add(t)
+            if plus is not None: plus[pred].update(tuples)
+            delta[pred] = Relation(tuples)
+         new = defaultdict(set)
+         for c in stratum:
+            for aux in self.fire(c, self.plans(c, delta), new):
+               yield aux
+
+   def plans(self, c, delta):
+      """
+      Returns the lists of relations to join for the body of c. With delta, one list per body atom
+      with delta tuples, reading that atom from delta, so only derivations using delta are found.
+      """
+      full = [self.db[pred] for pred, terms in c.body]
+      if delta is None: return [full]
+      return [full[:i] + [delta[pred]] + full[i+1:] for i, (pred, terms) in enumerate(c.body) if pred in delta]
+
+   def fire(self, c, plans, new, binding={}):
+      """
+      Applies clause c, joining each list of relations in plans, starting from binding.
+      New head tuples are added to new, the new aux tuples are yielded as (aux predicate, args tuple).
+      """
+      aux_rel = self.aux[c.aux_pred]
+      h_pred, h_terms = c.head
+      for sources in plans:
+         for b in self.solve(c, sources, 0, binding):
+            aux = tuple([b.get(t, t) for t in c.aux_args])
+            if aux in aux_rel: continue
+            aux_rel.add(aux)
+            if not c.hidden: yield c.aux_pred, aux
+            head = tuple([b.get(t, t) for t in h_terms])
+            if head not in self.db[h_pred]:
+               new[h_pred].add(head)
+
+   def insert(self, facts):
+      """ Adds facts to the model. See update. """
+      return self.update(facts, ())
+
+   def delete(self, facts):
+      """ Removes facts from the model. See update. """
+      return self.update((), facts)
+
+   def update(self, inserts, deletes):
+      """
+      Inserts and deletes (predicate, args) facts and maintains the model incrementally, stratum by stratum.
+      Insertions are propagated semi-naively. Deletions use delete-rederive (DRed): every derivation
+      that used a deleted tuple is deleted, then the deleted tuples that still have a derivation are
+      rederived. A deleted fact is deleted with its derivations too, so a fact deriving itself through a
+      cycle is not kept. Negated atoms turn insertions below them into deletions and the reverse.
+      Returns (added, removed), the aux tuples the model gained and lost, as (aux predicate, args) pairs.
+      """
+      plus, minus = defaultdict(set), defaultdict(set)     #Tuples that became true, false
+      added, removed = set(), set()
+      retracted = defaultdict(list)     #Deleted facts of derived predicates, rederived with the others
+      for pred, t in deletes:
+         if t in self.edb[pred]:
+            self.edb[pred].discard(t)
+            self.db[pred].remove(t)
+            minus[pred].add(t)
+            if pred in self.heads: retracted[pred].append((pred, t))
+      for pred, t in inserts:
+         self.edb[pred].add(t)
+         if t not in self.db[pred]:
+            self.db[pred].add(t)
+            plus[pred].add(t)
+
+      for stratum, (pos, neg) in izip(self.strata, self.users):
+         over = self.overdelete(pos, neg, plus, minus, removed)
+         for pred in set(c.head[0] for c in stratum):
+            over.extend(retracted.pop(pred, ()))
+
+         new = defaultdict(set)
+         for pred, t in over:              #Rederive
+            if self.supported(pred, t):
+               new[pred].add(t)
+         delta = dict((pred, Relation(tuples)) for pred, tuples in plus.iteritems() if tuples)
+         for c in stratum:
+            added.update(self.fire(c, self.plans(c, delta), new))
+            for pred, terms in c.neg:       #Derivations no longer blocked by a negated atom
+               for t in minus.get(pred, ()):
+                  binding = unify(terms, t)
+                  if binding is not None and t not in self.db[pred]:
+                     added.update(self.fire(c, self.plans(c, None), new, binding))
+         added.update(self.saturate(stratum, new, plus))
+
+      both = added & removed
+      return ([(pred, ','.join(aux)) for pred, aux in added - both],
+              [(pred, ','.join(aux)) for pred, aux in removed - both])
+
+   def overdelete(self, pos, neg, plus, minus, removed):
+      """
+      Deletes the aux tuples of a stratum that use a tuple in minus, or a negated atom whose tuple is
+      in plus, and then the head tuples they derived, transitively. Input facts are kept.
+      pos, neg - the body atoms of the stratum by predicate, from self.users
+      Returns the deleted head tuples as (predicate, tuple) pairs.
+      """
+      over = []
+      work = [(pred, t) for pred, tuples in minus.iteritems() if pred in pos for t in tuples]
+      for pred, tuples in plus.iteritems():
+         for c, terms in neg.get(pred, ()):
+            for t in tuples:
+               self.kill(c, terms, t, minus, removed, over, work)
+      while work:
+         pred, t = work.pop()
+         for c, terms in pos.get(pred, ()):
+            self.kill(c, terms, t, minus, removed, over, work)
+      return over
+
+   def kill(self, c, terms, t, minus, removed, over, work):
+      """ Deletes the aux tuples of c in which the body atom with terms is t, and their head tuples. """
+      key = c.aux_key(terms, t)
+      if key is None: return
+      aux_rel = self.aux[c.aux_pred]
+      h_pred = c.head[0]
+      for aux in list(aux_rel.lookup(*key)):
+         aux_rel.remove(aux)
+         if not c.hidden: removed.add((c.aux_pred, aux))
+         head = c.head_of(aux)
+         if head in self.db[h_pred] and head not in self.edb[h_pred]:
+            self.db[h_pred].remove(head)
+            minus[h_pred].add(head)
+            over.append((h_pred, head))
+            work.append((h_pred, head))
+
+   def supported(self, pred, t):
+      """ True if tuple t of pred is an input fact or has a derivation. """
+      if t in self.edb[pred]: return True
+      for c in self.heads[pred]:
+         key = c.aux_key(c.head[1], t)
+         if key is not None and c.aux_pred in self.aux and self.aux[c.aux_pred].lookup(*key):
+            return True
+      return False
+
+   def solve(self, c, sources, i, binding):
+      """ Generator over the bindings of the variables of c that satisfy its body, joining left to right. """
+      if i == len(c.body):
+         for pred, terms in c.neg:
+            if tuple([binding.get(t, t) for t in terms]) in self.db[pred]: return
+         yield binding
+         return
+
+      terms = c.body[i][1]
+      cols, key = [], []
+      for j, t in enumerate(terms):
+         if not is_var(t) or t in binding:
+            cols.append(j)
+            key.append(binding.get(t, t))
+      for tup in sources[i].lookup(tuple(cols), tuple(key)):
+         b = dict(binding)
+         for j, t in enumerate(terms):
+            if is_var(t) and b.setdefault(t, tup[j]) != tup[j]: break     #Repeated variable
+         else:
+            for r in self.solve(c, sources, i + 1, b):
+               yield r
+
+
+def stratify(clauses):
+   """
+   Orders clauses into strata, so every predicate used under negation is complete before it is used.
+   Returns a list of lists of clauses. Raises ValueError if the program is not stratified.
+   """
+   level = defaultdict(int)
+   n = len(set(c.head[0] for c in clauses))
+   changed = True
+   while changed:
+      changed = False
+      for c in clauses:
+         h = c.head[0]
+         for pred, offset in [(p, 0) for p, t in c.body] + [(p, 1) for p, t in c.neg]:
+            if level[h] < level[pred] + offset:
+               level[h] = level[pred] + offset
+               changed = True
+               if level[h] > n:
+                  raise ValueError('Program is not stratified, %s depends negatively on itself.' % h)
+
+   strata = defaultdict(list)
+   for c in clauses:
+      strata[level[c.head[0]]].append(c)
+   return [strata[l] for l in sorted(strata)]
+
+
+def dependencies(clauses, preds):
+   """ Returns the predicates preds depend on through clauses, positively or negatively, including preds. """
+   heads = defaultdict(list)
+   for c in clauses:
+      heads[c.head[0]].append(c)
+   found, work = set(preds), list(preds)
+   while work:
+      for c in heads[work.pop()]:
+         for pred, terms in c.body + c.neg:
+            if pred not in found:
+               found.add(pred)
+               work.append(pred)
+   return found
+
+def adornment(terms, bound):
+   """ Returns the adornment of an atom, b for each bound argument and f for each free one, eg. 'bf'. """
+   return ''.join('b' if not is_var(t) or t in bound else 'f' for t in terms)
+
+def demand(clauses, goal, terms=None):
+   """
+   Magic set rewriting of clauses for the goal atom goal(terms), terms None for all free.
+   Only clauses the goal depends on are kept. A clause of predicate p, used with adornment a, gets
+   the body atom magic_p_a(bound head arguments) in front, and for each body atom q its magic rule
+      magic_q_a'(bound arguments of q) :- magic_p_a(...), body atoms left of q.
+   Bindings pass left to right, the order solve() joins in. The magic rules are hidden clauses, so
+   only aux tuples of the original rules are reported. Predicates used under negation, and all
+   they depend on, are evaluated in full, which keeps the rewritten program stratified.
+   Returns the clauses and the seed facts, [(magic goal predicate, bound goal arguments)].
+   """
+   heads = defaultdict(list)
+   for c in clauses:
+      heads[c.head[0]].append(c)
+   if not heads[goal]: return [], []
+   if terms is None:
+      terms = ['_'] * len(heads[goal][0].head[1])
+   needed = dependencies(clauses, [goal])
+   full = dependencies(clauses, set(pred for c in clauses if c.head[0] in needed for pred, t in c.neg))
+
+   magic = lambda pred, a: 'magic_%s_%s' % (pred, a)
+   out = [c for c in clauses if c.head[0] in full]
+   a = adornment(terms, ())
+   seeds = [(magic(goal, a), tuple(t for t in terms if not is_var(t)))]
+   work, seen = [(goal, a)], set()
+   while work:
+      pred, a = work.pop()
+      if (pred, a) in seen or pred in full: continue
+      seen.add((pred, a))
+      for c in heads[pred]:
+         m_terms = [t for t, x in izip(c.head[1], a) if x == 'b']
+         body = [(magic(pred, a), m_terms)]
+         bound = set(t for t in m_terms if is_var(t))
+         for q, q_terms in c.body:
+            if heads[q] and q not in full:
+               qa = adornment(q_terms, bound)
+               out.append(magic_clause('magic_aux_%d' % len(out), (magic(q, qa), [t for t, x in izip(q_terms, qa) if x == 'b']), list(body)))
+               work.append((q, qa))
+            body.append((q, q_terms))
+            bound.update(t for t in q_terms if is_var(t))
+         guarded = copy(c)
+         guarded.body = body
+         out.append(guarded)
+   return out, seeds
+
+def magic_clause(aux_pred, head, body):
+   """ Returns a hidden clause head :- body. Its aux tuples hold every variable, for delete-rederive. """
+   c = Clause.__new__(Clause)
+   c.hidden = True
+   c.aux_pred = aux_pred
+   c.aux_args = []
+   for pred, terms in [head] + body:
+      c.aux_args.extend(t for t in terms if is_var(t) and t not in c.aux_args)
+   c.aux_pos = dict((t, i) for i, t in enumerate(c.aux_args))
+   c.head, c.body, c.neg = head, body, []
+   return c
@@ -8,37 +8,83 @@
 This is the command line interpreter for gddb. The main functionality is provided by the graphdlv module. 
 """
 
+import os
 import cmd
+import socket
+import json
+import getopt
 import sys
 import re
+import time
+import heapq
+import pstats
+import cProfile
+import tempfile
+import subprocess
+import multiprocessing
 import graphdlv
+import evaldlv
+import storedlv
+import snapdlv
+import servedlv
 draw = graphdlv.draw
-from copy import deepcopy
-from collections import defaultdict
+try:
+	import tracemalloc      #Python 3, or pytracemalloc
+except ImportError:
+	tracemalloc = None
 
 default_format = 'pdf'
 default_layout = 'dot'
+find_limit = 50          #Atoms listed by find
+snapshot_name = 'gddb.snap'   #Default file of save and load
+serve_port = 8000        #Default port of serve
+dlv_bin = os.environ.get('DLV', './dlv')
+trace_opts = {'-p': 'p', '-partial': 'p', '-s': 's', '-scc': 's', '-w': 'w', '-witness': 'w',
+              '-k': 'k', '-d': 'd', '-depth': 'd', '-n': 'n', '-nodes': 'n', '-x': 'x', '-precise': 'x'}
+atom_re = re.compile('(?:not )?[^\s(,]+\([^)]*\)|{[^}]*}')
 
 class GraphCMD(cmd.Cmd):
-	def __init__(self, parse_map, dlv_out, styles=False):
+	def __init__(self, parse_map, dlv_out, styles=False, evaluator=None, processes=1):
 		cmd.Cmd.__init__(self)
-		self.subg_dict, self.adj_list = graphdlv.build(parse_map, dlv_out)         
+		self.times = {}              #Phase -> wall time of its last run
+		self.profiler = None
+		state = None
+		if dlv_out is None and snapdlv.is_snapshot(parse_map):   #parse_map is a session snapshot
+			self.subg_dict, self.adj_list, parse_map, state = self.phase('build', snapdlv.load, parse_map)
+		elif dlv_out is None:                #parse_map is a store written by storedlv
+			self.subg_dict, self.adj_list, parse_map = self.phase('build', storedlv.load, parse_map)
+		else:
+			self.subg_dict, self.adj_list = self.phase('build', graphdlv.build, parse_map, dlv_out, processes)
+		self.rule_map = parse_map
+		self.evaluator = evaluator   #In-process evaluator the model came from, needed by assert/retract.
 		self.auto = False 
 		self.layout = default_layout 
 		self.fformat = default_format
-		self.saved_styles = defaultdict(lambda:{'nodes':{}, 'styles':{}})  
 		self.styles = graphdlv.read_styles(styles)
 		self.trace = None
+		self.trace_cache = graphdlv.TraceCache()
+		self.reach = None
+		self.dot_cache = graphdlv.DotCache(self.subg_dict)    #Serialized subgraphs of the main graph
+		self.renderer = graphdlv.Renderer(report=self.report) #Draws of auto mode
+		self.draw_job = None         #Job of the last draw in the foreground
+		self.summary = False         #Draw predicates as single nodes, see graphdlv.summarize
+		self.expanded = set()        #Predicates drawn in full in summaries
+		self.interactive = True      #False while running a script, draws wait for graphviz
+		self.workers = multiprocessing.cpu_count()   #Graphviz processes of batch
+		self.failures = 0            #Jobs of batch not drawn
 		self.ruler = '-'
+		if state: self.restore(state)
 		
 	def do_set(self, line):
-		"""Set attribute of the graph or subgraphs.\nUsage: set [subgraph] [edges|nodes] [attribute] [value]\n"""
+		"""Set attribute of the graph or subgraphs, or of the atoms matching a pattern such as tc(1,_).
+Edge attributes of a pattern style the derivation edges into its atoms.\nUsage: set [subgraph|pattern] [edges|nodes] [attribute] [value]\n"""
 		if len(line.split()) is not 4: 
-			print "Usage: set [subgraph] [graph|edges|nodes] [attribute] [value]\nTo reference entire graph use 'root' for subgraph name.\n"
+			print "Usage: set [subgraph|pattern] [graph|edges|nodes] [attribute] [value]\nTo reference entire graph use 'root' for subgraph name.\n"
 			return
 		subg, en, attr, value = line.split()
-		self.styles[subg][en][attr] = value
-		if(self.auto): 	draw(self.subg_dict, self.styles, self.layout, self.fformat, self.trace)
+		if self.trace: self.save_s.set(subg, en, attr, value)    #Session settings outlive the trace overlay
+		self.styles.set(subg, en, attr, value)
+		if(self.auto): self.redraw()
 
 	def do_auto(self, line):
 		"""Toggle Autodraw. When enabled graph is redrawn after each attribute is updated."""	
@@ -52,7 +98,7 @@ class GraphCMD(cmd.Cmd):
 		"""Set layout program of the graph.\nUsage: layout [dot|circo|neato|twopi|fdp|sfdp]"""
 		if line in graphdlv.layout_types:
 			self.layout = line
-			if(self.auto): draw(self.subg_dict, self.styles, self.layout, self.fformat, self.trace)
+			if(self.auto): self.redraw()
 		else:
 			print 'Layout not supported.'	
 
@@ -60,7 +106,7 @@ class GraphCMD(cmd.Cmd):
 		"""Set file format of the graph.\nUsage: format [pdf|gif|jpeg|png|ps]"""
 		if line in graphdlv.format_types:
 			self.fformat = line
-			if(self.auto): 	draw(self.subg_dict, self.styles, self.layout, self.fformat, self.trace)
+			if(self.auto): self.redraw()
 		else:
 			print 'Format not supported.'	
 	
@@ -88,7 +134,7 @@ class GraphCMD(cmd.Cmd):
 					print ('    %s=%s') % (key,value) 
 
 			for subg_k,subg_v in self.styles.iteritems():
-				if subg_k == 'root': continue
+				if subg_k in ('root', 'trace'): continue     #The trace entry holds only its color
 
 				#Check for subgraphs with no styles. All subgraphs have node,edge,graph attrs initialized to {}	
 				attrs = {}	
@@ -110,60 +156,487 @@ class GraphCMD(cmd.Cmd):
 			print "ls: invalid option %s" % line
 
 			
+	def do_save(self, line):
+		"""Save the session to a snapshot: the graph, styles, trace, layout and format. Opened again by load or
+gddb.py --resume much faster than building the graph. The in-process evaluator is not saved.\nUsage: save [file]"""
+		if len(line.split()) > 1:
+			print 'Usage: save [file]'
+			return
+		f_name = line.strip() or snapshot_name
+		graph = self.save_g if self.trace else self.subg_dict
+		self.atom_index()
+		self.phase('save', snapdlv.save, f_name, graph, self.adj_list, self.rule_map, self.state())
+		print 'Saved %s.' % f_name
+
+	def do_load(self, line):
+		"""Restore a session saved by save.\nUsage: load [file]"""
+		if len(line.split()) > 1:
+			print 'Usage: load [file]'
+			return
+		f_name = line.strip() or snapshot_name
+		if not snapdlv.is_snapshot(f_name):
+			print '%s is not a snapshot.' % f_name
+			return
+		try:
+			graph, adj_list, rule_map, state = self.phase('build', snapdlv.load, f_name)
+		except ValueError as e:
+			print e
+			return
+		self.renderer.cancel()
+		self.subg_dict, self.adj_list, self.rule_map = graph, adj_list, rule_map
+		self.evaluator = None
+		self.trace = None
+		self.trace_cache = graphdlv.TraceCache()
+		self.reach = None
+		self.dot_cache = graphdlv.DotCache(graph)
+		self.restore(state)
+		if(self.auto): self.redraw()
+
+	def state(self):
+		'''Returns the state of the session saved in snapshots, besides the graph.'''
+		styles = self.save_s if self.trace else self.styles
+		state = {'styles': styles.layers, 'layout': self.layout, 'format': self.fformat, 'auto': self.auto,
+			'summary': self.summary, 'expanded': sorted(self.expanded), 'trace': None}
+		if self.trace:
+			state['trace'] = dict((k, sorted(v) if isinstance(v, set) else v) for k, v in self.trace.iteritems())
+			state['trace_styles'] = self.styles.layers
+		return state
+
+	def restore(self, state):
+		'''Restores the state of the session returned by state(), over the main graph.'''
+		self.styles = graphdlv.Styles(state['styles'])
+		self.layout, self.fformat, self.auto = state['layout'], state['format'], state['auto']
+		self.summary, self.expanded = state['summary'], set(state['expanded'])
+		trace = state['trace']
+		if trace:
+			for k in ('nodes', 'edges', 'back_edges'):
+				trace[k] = set(tuple(x) if isinstance(x, list) else x for x in trace[k])
+			self.save_g, self.save_s = self.subg_dict, self.styles
+			if trace['type'] == 'partial':
+				self.subg_dict = graphdlv.pt_graph(trace)
+			self.styles = graphdlv.Styles(state['trace_styles'])
+			self.trace = trace
+
 	def do_draw(self, line):
 		"""Draw graph. Default format is pdf.\nUsage: draw [pdf|ps|jpeg|gif|png]"""
 		if not line: line = self.fformat
-		draw(self.subg_dict, self.styles, self.layout, line, self.trace)
+		self.draw_now(line)
 
 	def do_trace(self,line):
-		"""Trace the atom."""	
-		if not line:
-			print 'Usage: trace [-p] atom [color]'
+		"""Trace atoms. Patterns such as tc(1,_) trace every matching atom."""	
+		atoms = self.split_atoms(line)
+		opts, color = self.trace_options(atom_re.sub(' ', line).split())
+		if not atoms or opts is None:
+			print 'Usage: trace [-p] [-x] [-s | -w | -k K | -d N | -n M] atom ... [color]'
 			return
-		line = self.check_whitespace(line)
 		if not self.trace: 
 			self.save_g, self.save_s = self.subg_dict, self.styles # Backup main graph.  	
 		else: self.untrace()
 
-		if line[0] == '-p' or line[0] =='-partial':
-			trace = graphdlv.trace(self.adj_list, line[1]) 
-			if not trace:
-				print 'Atom not found.'
-				return
-			trace_styles = self.styles                         #Partial trace retains colors of parent graph.
-			trace_graph = graphdlv.pt_graph(trace)
-			t_type = 'partial'
-
-		else:	   
-			trace = graphdlv.trace(self.adj_list, line[0])
-			if not trace:
-				print 'Atom not found.'
-				return
-			trace_styles = graphdlv.trace_color(self.styles)   #Remove coloring from non trace subgraphs
-			if len(line) > 2:
-				trace_styles['trace']['color'] = {'color':line[2]}
-			trace_graph = self.subg_dict
-			t_type = 'full'
+		trace = self.trace_of(self.match_atoms(atoms), opts)
+		if not trace:
+			print 'Atom not found.'
+			return
+		self.subg_dict, self.styles = self.traced(trace, opts, color)
+		self.trace = trace
+		if(self.auto): self.redraw()
+
+	def trace_of(self, atoms, opts):
+		'''Returns the trace of atoms with the options of trace, None if none of them is in the graph.'''
+		adj_list = self.provenance('x' in opts)
+		if 's' in opts:
+			return self.phase('trace', self.reach_index().trace, atoms)  #Expand SCCs of the precomputed index
+		elif 'w' in opts or 'k' in opts:
+			return self.phase('trace', graphdlv.witness_all, adj_list, atoms, opts.get('k', 1))
+		elif 'd' in opts or 'n' in opts:
+			return self.phase('trace', graphdlv.bounded, adj_list, atoms, opts.get('d'), opts.get('n'))
+		else:
+			cache = None if 'x' in opts else self.trace_cache     #Cached provenance is not precise
+			return self.phase('trace', graphdlv.trace_all, adj_list, atoms, cache)
+
+	def traced(self, trace, opts, color):
+		'''Returns the graph and styles drawing trace over the main graph, and sets its type.'''
+		if 'p' in opts:
+			trace['type'] = 'partial'
+			return graphdlv.pt_graph(trace), self.styles          #Partial trace retains colors of parent graph.
+		trace['type'] = 'full'
+		return self.subg_dict, graphdlv.trace_color(self.styles, color or graphdlv.t_color)   #Remove coloring from non trace subgraphs
 
-		trace['type'] = t_type
-		self.subg_dict, self.styles, self.trace = trace_graph, trace_styles, trace
-		if(self.auto): 	draw(self.subg_dict, self.styles, self.layout, self.fformat, self.trace)
+	def trace_options(self, words):
+		'''Returns the options of trace, by letter, and the color. None for the options if words are not valid.'''
+		opts, color = {}, None
+		words = list(words)
+		while words:
+			w = words.pop(0)
+			opt = trace_opts.get(w)
+			if opt in ('k', 'd', 'n'):
+				if not words or not words[0].isdigit(): return None, None
+				opts[opt] = int(words.pop(0))
+			elif opt:
+				opts[opt] = True
+			elif not words and not w.startswith('-'):
+				color = w
+			else:
+				return None, None
+		if 's' in opts and ('w' in opts or 'k' in opts or 'd' in opts or 'n' in opts or 'x' in opts):
+			return None, None
+		return opts, color
 
 	def do_untrace(self,line):
 		"""Untrace; revert to main graph."""	
 		if self.trace:
 			self.untrace()
-			if(self.auto): 	draw(self.subg_dict, self.styles, self.layout, self.fformat)
+			if(self.auto): self.redraw()
 
 	def untrace(self):
 		self.trace = None
 		self.subg_dict, self.styles = self.save_g, self.save_s
 
+	def do_assert(self, line):
+		"""Add facts to the model and update the graph incrementally. Needs gddb -e.\nUsage: assert [atom] ..."""
+		self.update(line, 'assert')
+
+	def do_retract(self, line):
+		"""Remove facts from the model and update the graph incrementally. Needs gddb -e.\nUsage: retract [atom] ..."""
+		self.update(line, 'retract')
+
+	def update(self, line, op):
+		'''Applies assert or retract of the facts in line, patching the graph in place.'''
+		if not self.evaluator:
+			print '%s needs the in-process evaluator, start gddb with -e.' % op
+			return
+		facts = [self.parse_fact(atom) for atom in self.split_atoms(line)]
+		if not facts or None in facts:
+			print 'Usage: %s [atom] ...\nAtoms must be ground facts.' % op
+			return
+
+		if self.trace: self.untrace()
+		self.renderer.cancel()      #Background draws read the graph
+		added, removed = self.phase('build', self.apply, facts, op)
+		self.trace_cache = graphdlv.TraceCache()      #Provenance changed
+		self.reach = None
+		print '%d derivations added, %d removed.' % (len(added), len(removed))
+		if(self.auto): self.redraw()
+
+	def apply(self, facts, op):
+		'''Updates the model and patches the graph. Returns the aux tuples added and removed.'''
+		if op == 'assert':
+			added, removed = self.evaluator.insert(facts)
+		else:
+			added, removed = self.evaluator.delete(facts)
+		touched = set()
+		for g in removed:
+			touched |= graphdlv.remove_aux(self.subg_dict, self.adj_list, self.rule_map, g)
+		for g in added:
+			touched |= graphdlv.add_aux(self.subg_dict, self.adj_list, self.rule_map, g)
+		self.dot_cache.invalidate(touched)
+		return added, removed
+
+	def redraw(self):
+		'''Draws the current graph in the background, or in the foreground while profiling or running a script.'''
+		if self.profiler or not self.interactive:
+			self.draw_now(self.fformat)
+		else:
+			graph, attrs, cache = self.drawing()
+			self.renderer.draw(graph, self.styles.copy(), self.layout, self.fformat, self.trace, cache=cache, attrs=attrs)
+
+	def draw_now(self, out_format):
+		'''Draws the current graph and waits for it.'''
+		self.renderer.cancel()
+		self.draw_job = graphdlv.Job()
+		graph, attrs, cache = self.drawing()
+		self.phase('render', draw, graph, self.styles, self.layout, out_format, self.trace,
+			cache=cache, job=self.draw_job, attrs=attrs)
+
+	def drawing(self, graph=None, trace=None):
+		'''Returns the graph to draw, the attributes of its elements and its DotCache. In summary mode the summary of the
+		   graph, with the atoms of the trace drawn in full. Graph and trace default to the current ones.'''
+		if graph is None:
+			graph, trace = self.subg_dict, self.trace
+		if not self.summary:
+			return graph, None, self.dot_cache
+		keep = trace['nodes'] if trace else ()
+		graph, attrs = self.phase('summary', graphdlv.summarize, graph, self.rule_map, self.expanded, keep)
+		return graph, attrs, None
+
+	def do_summary(self, line):
+		"""Draw each predicate as one node with its number of atoms, and derivations between predicates as
+weighted edges. Expanded predicates and traced atoms are drawn in full.\nUsage: summary [on|off]"""
+		if line in ('', 'on'):
+			self.summary = True
+		elif line == 'off':
+			self.summary = False
+		else:
+			print 'Usage: summary [on|off]'
+			return
+		if(self.auto): self.redraw()
+
+	def do_expand(self, line):
+		"""Draw the atoms of predicates in summaries.\nUsage: expand [predicate] ..."""
+		preds = line.split()
+		unknown = [p for p in preds if p not in self.subg_dict]
+		if not preds or unknown:
+			print 'Usage: expand [predicate] ...' if not preds else 'No predicate %s.' % ', '.join(unknown)
+			return
+		self.expanded.update(preds)
+		if(self.auto and self.summary): self.redraw()
+
+	def do_collapse(self, line):
+		"""Draw predicates as single nodes again in summaries, all without arguments.\nUsage: collapse [predicate] ..."""
+		if line.split():
+			self.expanded.difference_update(line.split())
+		else:
+			self.expanded.clear()
+		if(self.auto and self.summary): self.redraw()
+
+	def phase(self, name, f, *args, **kwargs):
+		'''Runs f as phase name, recording its wall time and profiling it when profiling is on.'''
+		start = time.time()
+		if self.profiler: self.profiler.enable()
+		try:
+			return f(*args, **kwargs)
+		finally:
+			if self.profiler: self.profiler.disable()
+			self.times[name] = time.time() - start
+
+	def do_stats(self, line):
+		"""Print sizes of the graph, the atoms with most edges and the times of the last build, trace and render."""
+		print "----Subgraphs----"
+		print '%-24s %10s %10s' % ('subgraph', 'nodes', 'edges')
+		for key in sorted(self.subg_dict):
+			subg = self.subg_dict[key]
+			print '%-24s %10d %10d' % (key, len(subg['nodes']), len(subg['edges']))
+
+		adj_list = self.adj_list
+		n = len(adj_list)
+		fan_in = [len(adj_list.in_ids(i)) for i in xrange(n)]
+		fan_out = [len(adj_list.out_ids(i)) for i in xrange(n)]
+		print "----Adjacency----"
+		print '%d atoms, %d edges' % (n, sum(fan_in))
+		names = adj_list.atoms.names
+		for title, fan in (('fan-in', fan_in), ('fan-out', fan_out)):
+			print 'Largest %s:' % title
+			for i in heapq.nlargest(5, xrange(n), key=fan.__getitem__):
+				print '    %-40s %d' % (names[i], fan[i])
+
+		print "----Times----"
+		for name in ('build', 'trace'):
+			if name in self.times:
+				print '%s: %.3fs' % (name, self.times[name])
+		jobs = [j for j in (self.draw_job, self.renderer.done) if j]
+		if jobs:
+			job = max(jobs, key=lambda j: j.started)
+			print 'render: %.3fs, graphviz %.3fs' % (job.seconds, job.graphviz)
+
+	def do_profile(self, line):
+		"""Profile build, trace and render with cProfile, and memory with tracemalloc where available.
+Usage: profile on|off [file]"""
+		args = line.split()
+		if args[:1] == ['on'] and len(args) == 1:
+			if self.profiler:
+				print 'Already profiling.'
+				return
+			self.profiler = cProfile.Profile()
+			if tracemalloc: tracemalloc.start()
+			print 'Profiling. Auto mode draws in the foreground until profile off.'
+		elif args[:1] == ['off'] and len(args) <= 2:
+			if not self.profiler:
+				print 'Not profiling.'
+				return
+			f_name = args[1] if len(args) > 1 else 'gddb.prof'
+			pstats.Stats(self.profiler).sort_stats('cumulative').print_stats(20)
+			self.profiler.dump_stats(f_name)
+			if tracemalloc:
+				print "----Memory----"
+				for stat in tracemalloc.take_snapshot().statistics('lineno')[:10]:
+					print stat
+				tracemalloc.stop()
+			self.profiler = None
+			print 'Profile written to %s' % f_name
+		else:
+			print 'Usage: profile on|off [file]'
+
+	def report(self, msg):
+		'''Prints a message of the background renderer, and the prompt again.'''
+		sys.stdout.write('\n%s\n%s' % (msg, self.prompt))
+		sys.stdout.flush()
+
+	def do_depends(self, line):
+		"""Check whether an atom depends on another.\nUsage: depends [atom] [atom]"""
+		atoms = self.split_atoms(line)
+		if len(atoms) != 2:
+			print 'Usage: depends [atom] [atom]'
+			return
+		d = self.reach_index().depends(atoms[0], atoms[1])
+		if d is None:
+			print 'Atom not found.'
+		elif d:
+			print '%s depends on %s' % tuple(atoms)
+		else:
+			print '%s does not depend on %s' % tuple(atoms)
+
+	def reach_index(self):
+		'''Returns the SCC and reachability index of the graph, building it on first use.'''
+		if not self.reach:
+			self.reach = graphdlv.ReachIndex(self.provenance())
+		return self.reach
+
+	def provenance(self, precise=False):
+		'''Returns the adjacency to trace, with the negation edges. Precise traces link a negated atom to the atoms
+		   that hold for the same head instead, see graphdlv.Negations.'''
+		return graphdlv.Negations(self.adj_list, self.atom_index(), self.rule_map if precise else None)
+
+	def atom_index(self):
+		'''Returns the predicate and argument index of the atoms, built on first use if the adjacency has none.
+		   Stores read theirs on demand, see storedlv.StoredIndex.'''
+		if self.adj_list.index is None:
+			self.adj_list.index = graphdlv.AtomIndex(self.adj_list.atoms, self.subg_dict)
+		return self.adj_list.index
+
+	def do_find(self, line):
+		"""List the atoms matching patterns, such as se(a,_) or tc(X,X).\nUsage: find [pattern] ... [limit]"""
+		patterns = self.split_atoms(line)
+		rest = atom_re.sub(' ', line).split()
+		if not patterns or len(rest) > 1 or (rest and not rest[0].isdigit()):
+			print 'Usage: find [pattern] ... [limit]'
+			return
+		limit = int(rest[0]) if rest else find_limit
+		atoms = self.match_atoms(patterns)
+		for atom in atoms[:limit]:
+			print atom
+		if len(atoms) > limit:
+			print '... %d more' % (len(atoms) - limit)
+
+	def do_count(self, line):
+		"""Count the atoms matching patterns, or the atoms of every predicate.\nUsage: count [pattern] ..."""
+		index = self.atom_index()
+		patterns = self.split_atoms(line) + atom_re.sub(' ', line).split()   #Atoms, then bare predicates
+		if patterns:
+			for pattern in patterns:
+				print '%-40s %d' % (pattern, index.count(pattern))
+		else:
+			for pred, n in sorted(index.counts()):
+				print '%-40s %d' % (pred, n)
+
+	def do_batch(self, line):
+		"""Trace each atom on its own and render it to its own file, with up to N graphviz processes at a time.
+Prints a summary of the timings of the jobs and writes them all to batch.json in the output directory.
+Takes the options of trace, the default of -c is the number of CPUs.
+Usage: batch [-c N] [-o dir] [-f format] [trace options] atom ... [color]"""
+		words = atom_re.sub(' ', line).split()
+		batch, rest = {'-c': str(self.workers), '-o': '.', '-f': self.fformat}, []
+		while words:
+			w = words.pop(0)
+			if w in batch and words:
+				batch[w] = words.pop(0)
+			else:
+				rest.append(w)
+		opts, color = self.trace_options(rest)
+		patterns = self.split_atoms(line)
+		if not patterns or opts is None or not batch['-c'].isdigit() or not int(batch['-c']):
+			print 'Usage: batch [-c N] [-o dir] [-f format] [-p] [-x] [-s | -w | -k K | -d N | -n M] atom ... [color]'
+			return
+		out_dir, out_format = batch['-o'], batch['-f']
+		if out_format not in graphdlv.format_types:
+			print 'Format not supported.'
+			return
+		atoms = self.match_atoms(patterns)
+		if not atoms:
+			print 'Atom not found.'
+			return
+		if self.trace: self.untrace()
+		self.renderer.cancel()
+		if not os.path.isdir(out_dir): os.makedirs(out_dir)
+
+		cache = self.dot_cache
+		if not ('p' in opts or self.summary):   #Full traces share the layout of the main graph, make it once.
+			styles = graphdlv.trace_color(self.styles)
+			if not cache.layout(styles, self.layout, graphdlv.Job()): cache = None
+		def jobs():
+			taken = set()
+			for atom in atoms:
+				start = time.time()
+				trace = self.trace_of([atom], opts)
+				graph, styles = self.traced(trace, opts, color)
+				graph, attrs, graph_cache = self.drawing(graph, trace)
+				job = graphdlv.Job()
+				job.atom, job.trace = atom, time.time() - start
+				job.f_out = os.path.join(out_dir, file_name(atom, out_format, taken))
+				done.append(job)
+				yield job, (graph, styles, self.layout, out_format, trace), \
+					{'cache': graph_cache and cache, 'attrs': attrs, 'f_out': job.f_out}
+		done = []
+		start = time.time()
+		self.phase('batch', graphdlv.draw_all, jobs(), int(batch['-c']))
+		self.report_batch(done, out_dir, time.time() - start, int(batch['-c']))
+
+	def report_batch(self, jobs, out_dir, seconds, workers):
+		'''Prints the summary of the jobs of a batch and writes their timings to batch.json in out_dir.'''
+		failed = [j for j in jobs if not j.drawn]
+		self.failures += len(failed)
+		print '%d traces rendered to %s in %.1fs with %d workers, %d failed.' % (len(jobs) - len(failed), out_dir,
+			seconds, workers, len(failed))
+		print '%-10s %10s %10s %10s' % ('', 'total', 'mean', 'max')
+		for name, attr in (('trace', 'trace'), ('render', 'seconds'), ('graphviz', 'graphviz')):
+			times = [getattr(j, attr) for j in jobs]
+			print '%-10s %9.3fs %9.3fs %9.3fs' % (name, sum(times), sum(times) / len(times), max(times))
+		print 'Slowest:'
+		for j in heapq.nlargest(5, jobs, key=lambda j: j.trace + j.seconds):
+			print '    %-40s %.3fs' % (j.atom, j.trace + j.seconds)
+		for j in failed[:5]:
+			print 'Failed: %s' % j.atom
+		records = [{'atom': j.atom, 'file': j.f_out, 'drawn': j.drawn, 'trace_seconds': round(j.trace, 6),
+			'render_seconds': round(j.seconds, 6), 'graphviz_seconds': round(j.graphviz, 6)} for j in jobs]
+		with open(os.path.join(out_dir, 'batch.json'), 'w') as f:
+			json.dump({'seconds': round(seconds, 6), 'workers': workers, 'jobs': records}, f, indent=1, sort_keys=True)
+			f.write('\n')
+
+	def do_serve(self, line):
+		"""Serve find, count, trace and render queries over HTTP until interrupted, answering JSON or SVG.
+Drawings are cached by atoms, options, styles and layout. See servedlv for the endpoints.
+Usage: serve [port] [host], by default on localhost"""
+		words = line.split()
+		if len(words) > 2 or words and not words[0].isdigit():
+			print 'Usage: serve [port] [host]'
+			return
+		port = int(words[0]) if words else serve_port
+		host = words[1] if len(words) > 1 else '127.0.0.1'
+		if self.trace: self.untrace()
+		self.renderer.cancel()
+		try:
+			server = servedlv.Server(self, (host, port))
+		except socket.error as e:
+			print 'Could not serve on %s:%d: %s' % (host, port, e)
+			return
+		print 'Serving on http://%s:%d/, interrupt to stop.' % server.server_address[:2]
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			print
+		finally:
+			server.server_close()
+
+	def run_script(self, lines):
+		'''Runs the commands of lines without prompting, echoing each. Blank lines and lines starting with # are skipped.'''
+		self.interactive = False
+		for line in lines:
+			line = line.strip()
+			if not line or line.startswith('#'): continue
+			print '%s%s' % (self.prompt, line)
+			if self.onecmd(line): break
+
 	def help_trace(self):
 		print '\n'.join(['Render a provenance trace for the atom.',
-			'Usage: trace [Options] [atom] [color]',
-			'Options: -p, -partial',
-			'Partial trace retains styles of the parent graph. Full trace will render trace as color. Default color red.'])
+			'Usage: trace [Options] [atom] ... [color]',
+			'Options: -p, -partial; -x, -precise; -s, -scc; -w, -witness; -k K; -d N, -depth N; -n M, -nodes M',
+			'Atoms may be patterns, tc(1,_) or tc(X,X) trace every matching atom. Several atoms are traced together.',
+			'Partial trace retains styles of the parent graph. Full trace will render trace as color. Default color red.',
+			'-scc builds the full trace from the precomputed SCC index instead of searching the graph.',
+			'-witness traces one derivation of least depth instead of the full provenance, -k K the K least deep',
+			'derivations by different rule instances. -depth N stops N derivation steps below the atoms,',
+			'-nodes M once the trace has M atoms.',
+			'Negated atoms depend on every atom of their predicate. -precise links them only to the atoms that agree',
+			'with them on the arguments bound by the rule head, which answers why the negated atom holds.'])
 
 	def help_ls(self):
 		print '\n'.join(['List subgraphs or attributes of the graph.',
@@ -173,32 +646,125 @@ class GraphCMD(cmd.Cmd):
 	def do_EOF(self, line):
 		return True
 
-	def options(self, opt_l):
-		'''Prints options'''
-		print 'Options'
-		for x,y in opt_l:
-			print '-%s, --%s' % (x,y)
-	
-	def check_whitespace(self, line):
-		m = re.search('(not .+)', line)
-		if not m: return line.split()
-		atom = m.group(1)
-		line = re.sub('not .+', 'x', line)
-		line = line.split()
-		for i,e in enumerate(line): 
-			if e =='x':
-				line[i] = atom
-		return line
-		
+	def split_atoms(self, line):
+		'''Splits line into atoms, keeping negated atoms such as "not se(a,1)" whole.'''
+		return atom_re.findall(line)
+
+	def match_atoms(self, patterns):
+		'''Returns the atoms matching patterns, each once, in order.'''
+		atoms, seen = [], set()
+		for pattern in patterns:
+			for atom in self.atom_index().match(pattern):
+				if atom not in seen:
+					seen.add(atom)
+					atoms.append(atom)
+		return atoms
+
+	def parse_fact(self, atom):
+		'''Returns (predicate, args) of a ground atom such as "e(1,2)", None if atom is not ground.'''
+		m = re.match('([^\s(]+)\((.*)\)$', atom)
+		if not m: return None
+		args = tuple(a.strip() for a in m.group(2).split(','))
+		if [a for a in args if evaldlv.is_var(a)]: return None
+		return m.group(1), args
+
+def file_name(atom, out_format, taken):
+	'''Returns a name for the drawing of atom that is not in taken, and adds it to taken.'''
+	base = re.sub('[^\w.-]+', '_', atom).strip('_') or 'atom'
+	name, n = base, 1
+	while name in taken:
+		n += 1
+		name = '%s-%d' % (base, n)
+	taken.add(name)
+	return '%s.%s' % (name, out_format)
+
+def write_rules(rules):
+	'''Writes the auxiliary rules to a temporary file for dlv. Returns its name.'''
+	f = tempfile.NamedTemporaryFile(prefix='gddb', suffix='.dlv', delete=False)
+	f.write('\n'.join(map(str, rules)))
+	f.close()
+	return f.name
+
 if __name__ == '__main__':
-	if len(sys.argv) < 3:
-		print "Usage: gddb.py [parse_map] [dlv_out] [styles]"
+	usage = '\n'.join(["Usage: gddb.py [-j processes] [-o store] [--goal atom] -d [rules] [facts] [styles]",
+	                    "       gddb.py [-j processes] [-o store] [--goal atom] -e [rules] [facts] [styles]",
+	                    "       gddb.py [-j processes] [-o store] [parse_map] [dlv_out] [styles]",
+	                    "       gddb.py [store] [styles]",
+	                    "       gddb.py --resume snapshot",
+	                    "Server: gddb.py ... --serve port",
+	                    "Batch: gddb.py ... [-c workers] [--out dir] -a atoms | -b script"])
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], 'dej:o:a:b:c:', ['goal=', 'out=', 'resume=', 'serve='])
+		opts = dict(opts)
+		processes = int(opts.get('-j', 1))     #Build in parallel
+		workers = int(opts.get('-c', multiprocessing.cpu_count()))   #Graphviz processes of batch
+	except (getopt.GetoptError, ValueError):
+		print usage
+		sys.exit(1)
+	if '--resume' in opts:                    #Restore a session saved by save
+		args[:0] = [opts['--resume']]
+	store = opts.get('-o')                    #Save the built graph to a store
+	evaluate = '-e' in opts                   #Evaluate in-process instead of reading dlv output
+	run = '-d' in opts and not evaluate       #Parse the rules in-process and stream the model from dlv
+	stored = not evaluate and not run and args[:1] and (storedlv.is_store(args[0]) or snapdlv.is_snapshot(args[0]))
+	goal = opts.get('--goal')                 #Only instrument the rules the goal depends on
+	if goal:
+		goal = graphdlv.parse_pattern(goal)
+	if len(args) < 2 and not stored or goal and not (evaluate or run):
+		print usage
 		sys.exit(1)
 	else:
 		print "Graphical Datalog Debugger"
-	if len(sys.argv) == 3:
-		c = GraphCMD(sys.argv[1], sys.argv[2])
+	if stored:
+		args[1:1] = [None]
+	evaluator = None
+	dlv = None
+	if evaluate or run:
+		import parsedlv
+		try:
+			rules, rule_map = parsedlv.parse(open(args[0]).read())
+			if goal:
+				rules = parsedlv.relevant(rules, goal[0])
+				rule_map = parsedlv.rule_map_of(rules)
+			if evaluate:
+				evaluator = evaldlv.Evaluator(rules, evaldlv.read_facts(args[1]), goal)
+				args[:2] = rule_map, evaluator.run()
+		except ValueError as e:
+			print e
+			sys.exit(1)
+	if run:
+		aux_rules = write_rules(rules)
+		try:
+			dlv = subprocess.Popen([dlv_bin, aux_rules, args[1]], stdout=subprocess.PIPE)
+		except OSError as e:
+			os.remove(aux_rules)
+			print 'Could not run %s: %s' % (dlv_bin, e)
+			sys.exit(1)
+		args[:2] = rule_map, dlv.stdout
+	try:
+		c = GraphCMD(*args[:3], evaluator=evaluator, processes=processes)
+	except ValueError as e:                   #A snapshot or store this version cannot open
+		print e
+		sys.exit(1)
+	finally:
+		if dlv:
+			dlv.wait()
+			os.remove(aux_rules)
+	if dlv and dlv.returncode:
+		print 'dlv failed with exit status %d.' % dlv.returncode
+		sys.exit(1)
+	if store:
+		storedlv.save(store, c.subg_dict, c.adj_list, c.rule_map)
+	c.workers = workers
+	if '-a' in opts:                          #Render a trace of each atom listed, one per line
+		f = sys.stdin if opts['-a'] == '-' else open(opts['-a'])
+		c.run_script(['batch -o %s %s' % (opts.get('--out', '.'), ' '.join(c.split_atoms(f.read())))])
+	elif '-b' in opts:                        #Run the commands of a script instead of prompting
+		f = sys.stdin if opts['-b'] == '-' else open(opts['-b'])
+		c.run_script(f)
+	elif '--serve' in opts:                   #Answer queries over HTTP instead of prompting
+		c.run_script(['serve %s' % opts['--serve']])
 	else:
-		c = GraphCMD(sys.argv[1], sys.argv[2], sys.argv[3])
-	c.cmdloop()
-	
+		c.cmdloop()
+	if c.failures:
+		sys.exit(1)
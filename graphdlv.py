@@ -12,99 +12,734 @@ import re
 import sys
 import pickle
 import json
-import pydot as pd
+import subprocess
+import multiprocessing
+import threading
+import time
+import math
+import Queue
+from cStringIO import StringIO
 from collections import defaultdict
 from collections import namedtuple
-from copy import deepcopy
+from collections import deque
+from array import array
+from itertools import izip, chain, islice
 
-format_types = set(['gif', 'png', 'pdf', 'jpeg', 'ps'])
+format_types = set(['gif', 'png', 'pdf', 'jpeg', 'ps', 'svg'])
 layout_types = set(['dot','neato','twopi','circo','fdp','sfdp'])
 f_out_name = 'graph'   #Default output filename
 nt_color   = 'black'   #Default color for elements not included in the trace subgraph
 t_color    = 'red'     #Default color for elements included in the trace subgraph
+chunk_size = 1 << 20   #Bytes read at a time from dlv output
+shard_size = 1 << 16   #Aux tuples per shard of a parallel build
+render_delay = 0.3     #Seconds a background draw waits for newer requests
+aux_re     = re.compile('(aux[^(]*)\(([^)]*)\)')
+dot_stmt_re = re.compile(r'^\s*("(?:[^"\\]|\\.)*"|[^\s\[;]+)(?:\s*->\s*("(?:[^"\\]|\\.)*"|[^\s\[;]+))?\s*\[(.*?)\];', re.M | re.S)
+pos_re      = re.compile(r'\bpos="([^"]*)"')
 
 d_styles=('{"root":{"nodes":{"shape":"plaintext"}},'
           '"aux" :{"nodes":{"shape":"point"}},'
           '"negation_in":{"edges":{"color":"green","style":"dashed"}},'
           '"negation_out":{"edges":{"color":"red"}}}')
 
-def build(parse_map, dlv_output):
+adj = namedtuple('adj', ['in_edge','out_edge'])
+
+def build(parse_map, dlv_output, processes=1, index=True):
    """
    Builds agencency list and subgraph dictonary. Returns these as a tuple. 
    Subgraph dictionary is used for rendering. Adjacency list is used for tracing provenance.  
-   parse_map  - serialized dictionary of rule mappings created by parsedlv. 
+   The adjacency list is an Adjacency over interned atom IDs, see AtomTable. The subgraph dictionary
+   is a Graph, which stores only the nodes and reads the edges from the adjacency.
+   parse_map  - serialized dictionary of rule mappings created by parsedlv, or the dictionary itself. 
    dlv_output - the output model created by dlv using the auxiliary rules.
+                May be a filename, '-' for stdin, or an open file such as a pipe from dlv.
+                May also be an iterable of aux tuples, such as evaldlv.Evaluator.run().
+   processes  - worker processes. With more than one, shards of dlv_output are built in a
+                multiprocessing pool and merged in order, giving the same result as one process.
+                Capped at the number of CPUs, see build_parallel.
+   index      - also build the AtomIndex of the atoms, as adj_list.index.
    """
-   rules = pickle.load(open(parse_map))
-   dlv_out = open(dlv_output).read()
+   if isinstance(parse_map, dict):
+      rules = parse_map
+   else:
+      rules = pickle.load(open(parse_map))
+   if isinstance(dlv_output, basestring) or hasattr(dlv_output, 'read'):
+      dlv_output = read_aux(dlv_output)
+
+   if processes > 1:
+      graph, atoms, src, dst, negations = build_parallel(rules, dlv_output, processes)
+   else:
+      graph, atoms, src, dst, neg_out, negations = build_part(rules, dlv_output)
+   names = atoms.names
 
+   for pred in negations:            #Create negation class. Its in-edges are not stored, see Negations.
+      graph['negation']['nodes'].add(names[atoms.intern('{%s}' % pred)])
+   virtual_negations(graph)
+   adj_list = graph.adj_list = Adjacency(atoms, src, dst)
+   if index: adj_list.index = AtomIndex(atoms)
+   return (graph, adj_list)
+
+def build_part(rules, dlv_output):
+   """
+   Builds the subgraph nodes and edge list of the aux tuples dlv_output, without negation classes.
+   Returns (graph, atoms, src, dst, neg_out, negations): neg_out are the positions of the
+   negation_out edges in src/dst, negations the negated predicates in order of appearance.
+   """
    aux_count = 0
-   adj = namedtuple('adj', ['in_edge','out_edge'])     
-   adj_list = defaultdict(lambda: adj([],[]))   
-   m = re.findall('(aux[^(]*)\(([^)]*)\)', dlv_out) 
-   graph = defaultdict(lambda:{'nodes':set(), 'edges':set()})
-   negations = set() 
+   atoms = AtomTable()
+   names = atoms.names
+   src, dst = array('i'), array('i')      #Edge list, src[i] -> dst[i]
+   graph = Graph()
+   neg_out = array('i')
+   neg_edges = set()                      #(class ID, atom ID) of the negation_out edges
+   negations = []
    
-   for g in m:
+   for g in dlv_output:
       aux_count = aux_count + 1
-      pred = g[0]
-      argv = g[1].split(',')
-      p_list = rules[pred]     #Get the mapping from the aux tuple to the body/head
-      aux_atom = '%s(%s)' % (pred, g[1])
+      aux_atom, head, body = project(rules, g)   #Get the mapping from the aux tuple to the body/head
+      aux_id = atoms.intern(aux_atom)
       graph['aux']['nodes'].add(aux_atom)
       
       # Aux -> Head Edges
-      pred = p_list[0][0]     #Create aux->head edges, insert into graph and adj_list
-      argi = p_list[0][1]
-      args = [argv[i] for i in argi]
-      atom = "%s(%s)" % (pred, ','.join(args))
+      pred, atom = head       #Create aux->head edges, insert into graph and edge list
+      atom_id = atoms.intern(atom)
+      atom = names[atom_id]   #Share one string per atom between all sets and edges
 
       graph[pred]['nodes'].add(atom)                      
-      graph[pred]['edges'].add((aux_atom, atom))
-      adj_list[atom].in_edge.append(aux_atom)
-      adj_list[aux_atom].out_edge.append(aux_atom)  
+      src.append(aux_id)
+      dst.append(atom_id)
       
       # Body -> Aux Edges                    
-      for p in p_list[1:]:
-         pred, argi = p[0], p[1]
-         args = [argv[i] for i in argi]
-         atom = "%s(%s)" % (pred, ','.join(args))
+      for pred, atom in body:
+         atom_id = atoms.intern(atom)
+         atom = names[atom_id]
 
          n = re.search('not (.+)', pred)   #Find negations
          if n:
             n_pred = n.group(1)  
             neg_class = '{%s}' % n_pred
-            negations.add(n_pred)                    
-            graph['negation_out']['edges'].add((neg_class, atom))
-            adj_list[atom].in_edge.append(neg_class)
-            adj_list[neg_class].out_edge.append(atom)
-
-         graph[pred]['nodes'].add(atom) #Add nodes,edges to body predicates subgraphs
-         graph[pred]['edges'].add((atom, aux_atom))
-         adj_list[atom].out_edge.append(aux_atom) 
-         adj_list[aux_atom].in_edge.append(atom)
-
-   for pred in negations:                          #Create negation class
-      neg_class = '{%s}' % pred
-      graph['negation']['nodes'].add(neg_class)
-      for n in graph[pred]['nodes']:
-         graph['negation_in']['edges'].add((n,'{%s}' % pred))
-         adj_list[n].out_edge.append(neg_class)    
-         adj_list[neg_class].in_edge.append(n)
-   return (graph, adj_list)
+            if n_pred not in negations: negations.append(n_pred)
+            neg_id = atoms.intern(neg_class)
+            if (neg_id, atom_id) not in neg_edges:
+               if not neg_edges: graph['negation_out']
+               neg_edges.add((neg_id, atom_id))
+               neg_out.append(len(src))
+               src.append(neg_id)
+               dst.append(atom_id)
+
+         graph[pred]['nodes'].add(atom) #Add nodes to body predicates subgraphs
+         src.append(atom_id)
+         dst.append(aux_id)
+   return graph, atoms, src, dst, neg_out, negations
+
+def build_parallel(rules, dlv_output, processes):
+   """
+   Builds dlv_output in shards in a pool of up to processes workers, at most one per CPU, and merges
+   them in order. Returns (graph, atoms, src, dst, negations) as merge does.
+   A list of aux tuples is inherited by the forked workers, which are sent only the bounds of their
+   shards. Other input is sent shard by shard. With one CPU or one shard the merge and transfer would
+   only add to the time of building the tuples here, so they are built by build_part instead.
+   """
+   processes = min(processes, multiprocessing.cpu_count())
+   inherited = None
+   if isinstance(dlv_output, list):
+      inherited = dlv_output
+      size = min(shard_size, -(-len(dlv_output) // processes))
+      parts = [(i, i + size) for i in xrange(0, len(dlv_output), size)]
+      serial = len(parts) < 2
+   else:
+      dlv_output = iter(dlv_output)
+      first = list(islice(dlv_output, shard_size))
+      serial = len(first) < shard_size          #Nothing after the first shard
+      parts = chain([first], shards(dlv_output, shard_size))
+      dlv_output = chain(first, dlv_output)
+   if processes < 2 or serial:
+      graph, atoms, src, dst, neg_out, negations = build_part(rules, dlv_output)
+      return graph, atoms, src, dst, negations
+
+   pool = multiprocessing.Pool(processes, init_shard, (rules, inherited))
+   try:
+      return merge(pool.imap(build_shard, parts))
+   finally:
+      pool.terminate()
+
+def shards(dlv_output, size):
+   """ Splits the aux tuples of dlv_output into lists of size tuples. """
+   it = iter(dlv_output)
+   while True:
+      shard = list(islice(it, size))
+      if not shard: return
+      yield shard
+
+def init_shard(rules, dlv_output):
+   global shard_rules, shard_input
+   shard_rules = rules
+   shard_input = dlv_output
+
+def build_shard(shard):
+   """
+   Builds one shard in a pool worker. The shard is a list of aux tuples, or the (start, end) bounds
+   of its tuples in the inherited input list.
+   Returns the nodes of each subgraph as an array of shard atom IDs, the atoms of the shard in ID order,
+   and the edge list, negation_out positions and negated predicates made by build_part.
+   """
+   if isinstance(shard, tuple):
+      shard = shard_input[shard[0]:shard[1]]
+   graph, atoms, src, dst, neg_out, negations = build_part(shard_rules, shard)
+   ids = atoms.ids
+   nodes = dict((key, array('i', map(ids.__getitem__, subg['nodes']))) for key, subg in graph.iteritems())
+   return nodes, atoms.names, src, dst, neg_out, negations
+
+def merge(parts):
+   """
+   Merges the shards built by build_shard, in order, into the graph, atoms, edge list and
+   negated predicates that build_part would have made from all of them.
+   Atoms new to a shard are interned in its ID order, which is the order build_part meets them in.
+   Its arrays are then mapped to those IDs in bulk.
+   """
+   atoms = AtomTable()
+   ids, names = atoms.ids, atoms.names
+   src, dst = array('i'), array('i')
+   graph = Graph()
+   neg_edges = set()
+   negations = []
+   for part_nodes, part_names, part_src, part_dst, neg_out, part_negations in parts:
+      new = [a for a in part_names if a not in ids]
+      ids.update(izip(new, xrange(len(names), len(names) + len(new))))
+      names.extend(new)
+      local = array('i', map(ids.__getitem__, part_names))     #Shard ID -> ID
+      part_src = array('i', map(local.__getitem__, part_src))
+      part_dst = array('i', map(local.__getitem__, part_dst))
+      start = 0
+      for k in neg_out:
+         e = (part_src[k], part_dst[k])
+         if e in neg_edges:          #Already added by an earlier shard
+            src.extend(part_src[start:k])
+            dst.extend(part_dst[start:k])
+            start = k + 1
+         neg_edges.add(e)
+      src.extend(part_src[start:])
+      dst.extend(part_dst[start:])
+      for key, nodes in part_nodes.iteritems():
+         graph[key]['nodes'].update(map(names.__getitem__, map(local.__getitem__, nodes)))
+      negations.extend(n for n in part_negations if n not in negations)
+   return graph, atoms, src, dst, negations
+
+def project(rules, g):
+   """
+   Maps aux tuple g to the atoms of its rule, using the rule map.
+   Returns the aux atom, the head as a (predicate, atom) pair and a list of such pairs for the body.
+   """
+   pred, args = g
+   argv = args.split(',')
+   atoms = [(p, '%s(%s)' % (p, ','.join([argv[i] for i in argi]))) for p, argi in rules[pred]]
+   return '%s(%s)' % (pred, args), atoms[0], atoms[1:]
+
+
+def add_aux(graph, adj_list, rules, g):
+   """
+   Adds the derivation given by aux tuple g to the subgraph dictionary and adjacency list in place,
+   as build() would have. Returns the keys of the subgraphs that changed.
+   """
+   atoms = adj_list.atoms
+   aux_atom, head, body = project(rules, g)
+   aux_id = atoms.intern(aux_atom)
+   aux_atom = atoms.names[aux_id]
+   graph['aux']['nodes'].add(aux_atom)
+   adj_list.indexed(aux_id, True)
+   touched = set(['aux'])
+
+   pred, atom = head
+   atom_id = atoms.intern(atom)
+   touched.update(add_atom(graph, adj_list, pred, atoms.names[atom_id]))
+   change_edge(graph, pred, (aux_atom, atoms.names[atom_id]), True)
+   adj_list.add_edge(aux_id, atom_id)
+
+   for pred, atom in body:
+      atom_id = atoms.intern(atom)
+      touched.update(add_atom(graph, adj_list, pred, atoms.names[atom_id]))
+      change_edge(graph, pred, (atoms.names[atom_id], aux_atom), True)
+      adj_list.add_edge(atom_id, aux_id)
+   return touched
+
+def remove_aux(graph, adj_list, rules, g):
+   """
+   Removes the derivation given by aux tuple g from the subgraph dictionary and adjacency list in place.
+   Atoms left without derivation edges are removed too. Returns the keys of the subgraphs that changed.
+   """
+   ids = adj_list.atoms.ids
+   aux_atom, head, body = project(rules, g)
+   aux_id = ids[aux_atom]
+   graph['aux']['nodes'].discard(aux_atom)
+   adj_list.indexed(aux_id, False)
+   touched = set(['aux'])
+
+   pred, atom = head
+   change_edge(graph, pred, (aux_atom, atom), False)
+   adj_list.remove_edge(aux_id, ids[atom])
+   for pred, atom in body:
+      change_edge(graph, pred, (atom, aux_atom), False)
+      adj_list.remove_edge(ids[atom], aux_id)
+
+   for pred, atom in [head] + body:
+      touched.add(pred)
+      if atom in graph[pred]['nodes'] and isolated(adj_list, ids[atom]):
+         touched.update(remove_atom(graph, adj_list, pred, atom))
+   return touched
+
+def add_atom(graph, adj_list, pred, atom):
+   """ Adds atom to the subgraph of pred if it is new, with its negation class and edge. Returns the keys of changed subgraphs. """
+   if atom in graph[pred]['nodes']: return set([pred])
+   ids = adj_list.atoms.ids
+   graph[pred]['nodes'].add(atom)
+   adj_list.indexed(ids[atom], True)
+   touched = set([pred])
+
+   if 'negation' in graph and '{%s}' % pred in graph['negation']['nodes']:   #pred is negated somewhere
+      touched.add('negation_in')
+
+   n = re.search('not (.+)', pred)
+   if n:
+      n_pred = n.group(1)
+      neg_class = '{%s}' % n_pred
+      if neg_class not in graph['negation']['nodes']:  #Create negation class
+         neg_id = adj_list.atoms.intern(neg_class)
+         graph['negation']['nodes'].add(neg_class)
+         graph['negation_out']
+         virtual_negations(graph)
+         adj_list.indexed(neg_id, True)
+         touched.update(['negation', 'negation_in'])
+      change_edge(graph, 'negation_out', (neg_class, atom), True)
+      adj_list.add_edge(ids[neg_class], ids[atom])
+      touched.add('negation_out')
+   return touched
+
+def remove_atom(graph, adj_list, pred, atom):
+   """ Removes atom from the subgraph of pred, with its negation class and edge. Returns the keys of changed subgraphs. """
+   ids = adj_list.atoms.ids
+   graph[pred]['nodes'].discard(atom)
+   adj_list.indexed(ids[atom], False)
+   touched = set([pred])
+
+   if 'negation' in graph and '{%s}' % pred in graph['negation']['nodes']:
+      touched.add('negation_in')
+
+   n = re.search('not (.+)', pred)
+   if n:
+      n_pred = n.group(1)
+      neg_class = '{%s}' % n_pred
+      change_edge(graph, 'negation_out', (neg_class, atom), False)
+      adj_list.remove_edge(ids[neg_class], ids[atom])
+      touched.add('negation_out')
+      if not graph[pred]['nodes']:                     #Last negated atom, remove negation class
+         graph['negation']['nodes'].discard(neg_class)
+         adj_list.indexed(ids[neg_class], False)
+         touched.update(['negation', 'negation_in'])
+   return touched
+
+def change_edge(graph, key, e, present):
+   """ Adds edge e to subgraph key, or removes it. A Graph reads its edges from the adjacency instead. """
+   if isinstance(graph, Graph): return
+   if present:
+      graph[key]['edges'].add(e)
+   else:
+      graph[key]['edges'].discard(e)
+
+def isolated(adj_list, i):
+   """ True if atom ID i has no edges other than to negation classes. """
+   names = adj_list.atoms.names
+   for j in chain(adj_list.in_ids(i), adj_list.out_ids(i)):
+      if not names[j].startswith('{'): return False
+   return True
+
+
+class AtomTable(object):
+   """ Intern table for atoms. Every atom string is stored once and identified by an int ID. """
+   def __init__(self):
+      self.ids = {}      #atom -> ID
+      self.names = []    #ID -> atom
+
+   def intern(self, atom):
+      """ Returns the ID of atom, assigning the next free ID if it is new. """
+      i = self.ids.get(atom)
+      if i is None:
+         i = self.ids[atom] = len(self.names)
+         self.names.append(atom)
+      return i
+
+   def __len__(self):
+      return len(self.names)
+
+   def __contains__(self, atom):
+      return atom in self.ids
+
+
+class AtomIndex(object):
+   """
+   Predicate and argument index of the atoms of a graph, by atom ID.
+   pred_of - atom ID -> position of its predicate in preds, -1 for atoms not in the graph.
+   members - predicate position -> IDs of its atoms. Removed atoms are left in place and
+             skipped by pred_of, so removal is O(1).
+   listed  - atom ID -> 1 if it is in members, so an atom added again is not listed twice.
+   args    - predicate position -> argument position -> value -> atom IDs, of the same atoms
+             as members. Built on the first query binding an argument of the predicate.
+   """
+   def __init__(self, atoms, graph=None):
+      self.atoms = atoms
+      self.preds, self.pred_ids = [], {}
+      self.pred_of, self.listed = array('i'), array('b')
+      self.members, self.sizes, self.args = [], [], {}
+      if graph is None:
+         for i, atom in enumerate(atoms.names):
+            self.add(i, atom)
+      else:
+         for subg in graph.itervalues():
+            for atom in subg['nodes']:
+               self.add(atoms.ids[atom], atom)
+
+   def add(self, i, atom=None):
+      """ Indexes atom ID i. """
+      while len(self.pred_of) <= i:
+         self.pred_of.append(-1)
+         self.listed.append(0)
+      if self.pred_of[i] != -1: return
+      if atom is None: atom = self.atoms.names[i]
+      pred = predicate(atom)
+      p = self.pred_ids.get(pred)
+      if p is None:
+         p = self.pred_ids[pred] = len(self.preds)
+         self.preds.append(pred)
+         self.members.append(array('i'))
+         self.sizes.append(0)
+      self.pred_of[i] = p
+      self.sizes[p] += 1
+      if not self.listed[i]:
+         self.listed[i] = 1
+         self.members[p].append(i)
+         if p in self.args:
+            self.add_args(self.args[p], i, atom)
+
+   def add_args(self, index, i, atom):
+      for pos, a in enumerate(arguments(atom)):
+         index[pos][a].append(i)
+
+   def remove(self, i):
+      """ Drops atom ID i from the index. """
+      if i < len(self.pred_of) and self.pred_of[i] != -1:
+         self.sizes[self.pred_of[i]] -= 1
+         self.pred_of[i] = -1
+
+   def arg_index(self, p):
+      """ Returns the argument index of predicate position p, building it on first use. """
+      index = self.args.get(p)
+      if index is None:
+         index = self.args[p] = defaultdict(lambda: defaultdict(lambda: array('i')))
+         names = self.atoms.names
+         for i in self.members[p]:
+            self.add_args(index, i, names[i])
+      return index
+
+   def find(self, pattern):
+      """
+      Returns the IDs of the atoms matching pattern, an atom whose variables (upper case or _) match
+      any argument, eg. tc(1,_) or tc(X,X).
+      """
+      pred, terms = parse_pattern(pattern)
+      p = self.pred_ids.get(pred)
+      if p is None: return []
+      if terms is None:
+         return [i for i in self.members[p] if self.pred_of[i] == p]
+      bound = [(pos, t) for pos, t in enumerate(terms) if not is_var(t)]
+      if bound:
+         index = self.arg_index(p)
+         candidates = min((index[pos].get(t, ()) for pos, t in bound), key=len)
+      else:
+         candidates = self.members[p]
+      names = self.atoms.names
+      found = set()
+      for i in candidates:
+         if self.pred_of[i] == p and i not in found and matches(terms, arguments(names[i])):
+            found.add(i)
+      return sorted(found)
+
+   def count(self, pattern):
+      """ Returns the number of atoms matching pattern. """
+      pred, terms = parse_pattern(pattern)
+      if terms is None:
+         p = self.pred_ids.get(pred)
+         return 0 if p is None else self.sizes[p]
+      return len(self.find(pattern))
+
+   def counts(self):
+      """ Returns (predicate, number of atoms) of every predicate with atoms. """
+      return [(pred, self.sizes[p]) for p, pred in enumerate(self.preds) if self.sizes[p]]
+
+   def match(self, pattern):
+      """ Returns the atoms matching pattern, sorted. """
+      names = self.atoms.names
+      return sorted(names[i] for i in self.find(pattern))
+
+
+class Adjacency(object):
+   """
+   Adjacency of the provenance graph in compressed sparse row form.
+   The in-edges of atom ID i are in_idx[in_ptr[i]:in_ptr[i+1]], likewise for out-edges.
+   Edges keep the order in which build() produced them, so traversals visit them in the same order.
+   Rows changed by add_edge/remove_edge are copied into lists in in_rows/out_rows, which are folded
+   back into the arrays by compact() once they grow large.
+   Indexing by atom string returns adj(in_edge, out_edge) lists of atoms, as the old adjacency list did.
+   """
+   def __init__(self, atoms, src, dst):
+      self.atoms = atoms
+      self.n = n = len(atoms)     #Atoms covered by the arrays
+      self.in_ptr, self.in_idx = csr(n, dst, src)
+      self.out_ptr, self.out_idx = csr(n, src, dst)
+      self.in_rows, self.out_rows = {}, {}
+      self.index = None           #AtomIndex of the atoms, set by build()
+
+   def in_ids(self, i):
+      """ Returns IDs of the atoms with an edge into atom ID i. """
+      row = self.in_rows.get(i)
+      if row is not None: return row
+      if i >= self.n: return ()
+      return self.in_idx[self.in_ptr[i]:self.in_ptr[i+1]]
+
+   def out_ids(self, i):
+      """ Returns IDs of the atoms atom ID i has an edge into. """
+      row = self.out_rows.get(i)
+      if row is not None: return row
+      if i >= self.n: return ()
+      return self.out_idx[self.out_ptr[i]:self.out_ptr[i+1]]
+
+   def add_edge(self, u, v):
+      """ Adds edge u -> v between atom IDs. """
+      self.row(True, u).append(v)
+      self.row(False, v).append(u)
+
+   def remove_edge(self, u, v):
+      """ Removes one edge u -> v between atom IDs. """
+      self.row(True, u).remove(v)
+      self.row(False, v).remove(u)
+
+   def indexed(self, i, present):
+      """ Adds atom ID i to the AtomIndex, or removes it. """
+      if self.index is not None:
+         if present:
+            self.index.add(i)
+         else:
+            self.index.remove(i)
+
+   def row(self, out, i):
+      """ Returns the out- or in-edges of atom ID i as a list that may be changed in place. """
+      if len(self.in_rows) + len(self.out_rows) > (self.n >> 1) + 1024: self.compact()
+      rows, ids = (self.out_rows, self.out_ids) if out else (self.in_rows, self.in_ids)
+      r = rows.get(i)
+      if r is None:
+         r = rows[i] = list(ids(i))
+      return r
+
+   def compact(self):
+      """ Rebuilds the arrays from the current rows. """
+      n = len(self.atoms)
+      rows = []
+      for ids in (self.in_ids, self.out_ids):
+         ptr, idx = array('l', [0]), array('i')
+         for i in xrange(n):
+            idx.extend(ids(i))
+            ptr.append(len(idx))
+         rows.append((ptr, idx))
+      (self.in_ptr, self.in_idx), (self.out_ptr, self.out_idx) = rows
+      self.in_rows, self.out_rows = {}, {}
+      self.n = n
+
+   def __getitem__(self, atom):
+      i = self.atoms.ids[atom]
+      names = self.atoms.names
+      return adj([names[j] for j in self.in_ids(i)], [names[j] for j in self.out_ids(i)])
+
+   def __contains__(self, atom):
+      i = self.atoms.ids.get(atom)
+      return i is not None and bool(len(self.in_ids(i)) or len(self.out_ids(i)))
+
+   def __len__(self):
+      return len(self.atoms)
+
+   def __iter__(self):
+      return iter(self.atoms.names)
+
+
+def csr(n, keys, values):
+   """
+   Groups values by key into CSR arrays (ptr, idx) for keys 0..n-1.
+   Counting sort, so values keep their relative order within a row.
+   """
+   ptr = array('l', [0]) * (n + 1)
+   for k in keys:
+      ptr[k + 1] += 1
+   for i in xrange(n):
+      ptr[i + 1] += ptr[i]
+   idx = array('i', [0]) * len(values)
+   pos = ptr[:-1]
+   for k, v in izip(keys, values):
+      idx[pos[k]] = v
+      pos[k] += 1
+   return ptr, idx
+
+
+def read_aux(dlv_output):
+   """
+   Generator over the aux tuples in a dlv model. Yields (predicate, args) pairs, eg. ('aux_tc_0', '2,1').
+   The model is read chunk_size bytes at a time, so neither the whole text nor the whole match
+   list is kept in memory. Works on pipes as well as regular files.
+   """
+   if hasattr(dlv_output, 'read'):
+      f_in = dlv_output
+   elif dlv_output == '-':
+      f_in = sys.stdin
+   else:
+      f_in = open(dlv_output)
+
+   tail = ''
+   while True:
+      chunk = f_in.read(chunk_size)
+      if not chunk: break
+      buf = tail + chunk
+      end = buf.rfind(')') + 1          #Atoms after the last ')' may be incomplete, keep them for the next chunk.
+      for m in aux_re.finditer(buf, 0, end):
+         yield m.groups()
+      tail = buf[end:]
 
 
 def read_styles(f_in):
-   """ Reads styles from external style sheet, f_in. """
-   l = lambda:defaultdict(l)
+   """ Reads styles from external style sheet, f_in. Returns Styles of the sheet with an empty session layer. """
    if not f_in:                            
-      styles = json.loads(d_styles, object_hook=lambda x: defaultdict(l, x))
+      sheet = json.loads(d_styles)
    else:
-      styles = json.load(open(f_in), object_hook=lambda x: defaultdict(l, x))
-   return styles
+      sheet = json.load(open(f_in))
+   return Styles((sheet, {}))
+
+
+class Style(dict):
+   """ Resolved style entry, kind -> attributes. Missing kinds read as empty without being added. """
+   def __missing__(self, kind):
+      return {}
+
+class Styles(object):
+   """
+   Layered style sheet. A layer maps subgraph key -> {'nodes'|'edges'|'graph': {attribute: value}},
+   layers are read in order so later ones take precedence: the style sheet, settings of the
+   session, then the overlay of a trace.
+   Layers are never changed once shared. set() copies the path it changes in the top layer, so copies
+   and overlays cost O(1) and share everything else.
+   Keys that are atom patterns, eg. tc(1,_), are selectors styling the atoms they match, see Selectors.
+   """
+   def __init__(self, layers=({},)):
+      self.layers = tuple(layers)
+      self.resolved = {}         #Key -> Style of the current layers
+      self.compiled = None       #(layers, Selectors) of the selector keys
+
+   def __getitem__(self, key):
+      style = self.resolved.get(key)
+      if style is None:
+         style = self.resolved[key] = Style()
+         for layer in self.layers:
+            for kind, value in layer.get(key, {}).iteritems():
+               if isinstance(value, dict):
+                  attrs = style[kind] = dict(style[kind])
+                  attrs.update(value)
+               else:
+                  style[kind] = value
+      return style
+
+   def __iter__(self):
+      seen = set()
+      for layer in self.layers:
+         for key in layer:
+            if key not in seen:
+               seen.add(key)
+               yield key
+
+   def iteritems(self):
+      for key in self:
+         yield key, self[key]
+
+   def set(self, key, kind, attr, value):
+      """ Sets attribute attr of kind of subgraph or selector key in the top layer. """
+      top = dict(self.layers[-1])
+      entry = top[key] = dict(top.get(key, {}))
+      attrs = entry[kind] = dict(entry.get(kind, {}))
+      attrs[attr] = value
+      self.layers = self.layers[:-1] + (top,)
+      self.resolved = {}
+
+   def copy(self):
+      """ Returns a copy, changes to either are not seen by the other. """
+      styles = Styles(self.layers)
+      styles.compiled = self.compiled
+      return styles
+
+   def overlay(self, layer):
+      """ Returns a copy with layer on top. """
+      return Styles(self.layers + (layer,))
+
+   def selectors(self):
+      """ Returns the Selectors of the pattern keys, compiled once for the current layers. """
+      if self.compiled is None or self.compiled[0] is not self.layers:
+         self.compiled = self.layers, Selectors((key, self[key]) for key in self if '(' in key)
+      return self.compiled[1]
+
+
+class Selectors(object):
+   """
+   Styles of the atoms matching patterns, compiled into lookup tables by predicate.
+   A selector with a constant argument, eg. tc(1,_), is found by one dict lookup on the value of its
+   first constant. Those with only variables, eg. tc(X,X), are tested on every atom of their predicate.
+   Later selectors take precedence. Their node attributes style the matching atoms, their edge
+   attributes the derivation edges into them.
+   preds - predicate -> (position -> {value: [selector]}, [selector]), a selector is (order, terms, style)
+   """
+   def __init__(self, styles):
+      self.preds = {}
+      for n, (pattern, style) in enumerate(styles):
+         pred, terms = parse_pattern(pattern)
+         keyed, scanned = self.preds.setdefault(pred, ({}, []))
+         consts = [i for i, t in enumerate(terms) if not is_var(t)]
+         if consts:
+            keyed.setdefault(consts[0], {}).setdefault(terms[consts[0]], []).append((n, terms, style))
+         else:
+            scanned.append((n, terms, style))
+
+   def __len__(self):
+      return len(self.preds)
+
+   def attrs(self, graph):
+      """ Returns the attributes of the elements of graph styled by the selectors, by subgraph as from proc_ft. """
+      attrs = defaultdict(dict)
+      for pred, (keyed, scanned) in self.preds.iteritems():
+         if pred not in graph: continue
+         subg = graph[pred]
+         heads = {}
+         for atom in subg['nodes']:
+            args = arguments(atom)
+            found = list(scanned)
+            for i, values in keyed.iteritems():
+               if i < len(args): found.extend(values.get(args[i], ()))
+            if not found: continue
+            nodes, edges = {}, {}
+            for n, terms, style in sorted(found):
+               if matches(terms, args):
+                  nodes.update(style['nodes'])
+                  edges.update(style['edges'])
+            if nodes: attrs[pred][atom] = nodes
+            if edges: heads[atom] = edges
+         if heads:
+            for e in subg['edges']:
+               edges = heads.get(e[1])
+               if edges: attrs[pred][e] = edges
+      return attrs
 
    
-def draw(graph, styles, layout, out_format, trace={}):
+def draw(graph, styles, layout, out_format, trace={}, cache=None, job=None, attrs=None, f_out=None):
    """
    Renders the graph to dot file using specified graphviz layout and file format.
    Parameters:
@@ -113,165 +748,1086 @@ def draw(graph, styles, layout, out_format, trace={}):
      layout -  graphviz layout eg. dot, circo
      format -  output file format eg. pdf, gif
      trace  -  a provenance trace
+     cache  -  a DotCache of graph
+     job    -  a Job, to cancel the draw from another thread. It records the times of the draw.
+     attrs  -  attributes of elements of graph by subgraph, eg. from summarize(). They take precedence over
+               the selectors of styles, those of the trace over both.
+     f_out  -  output file, default f_out_name with the extension of the format. '-' keeps the output in job.output.
+   Returns True if the graph was drawn.
    """
-
-   G = pd.Dot()  #Dot is derived class of Graph
-
-   #Set attributes for root graph.
-   graph_attr = styles['root']['graph']
-   node_attr = styles['root']['nodes']
-   edge_attr = styles['root']['edges']
-   G.set_node_defaults(**node_attr)
-   G.set_edge_defaults(**edge_attr)
-   G.set_graph_defaults(**graph_attr)
-
-   #Add aux subgraph first
-   subG_aux = pd.Subgraph('"aux"')
-   node_attr = styles['aux']['nodes']
-   subG_aux.set_node_defaults(**node_attr)
-   for n in graph['aux']['nodes']:
-      n = pd.Node(n)
-      subG_aux.add_node(n)
-   G.add_subgraph(subG_aux)
-
-   #Add remaining nodes and attributes by subgraph.
-   for key,subg in graph.iteritems():
-      if key =='aux': continue
-
-      node_attr = styles[key]['nodes']
-      edge_attr = styles[key]['edges']
-      graph_attr = styles[key]['graph']
-      subG = pd.Subgraph('"%s"'% key)
-      subG.set_node_defaults(**node_attr)
-      subG.set_edge_defaults(**edge_attr)
-      subG.set_graph_defaults(**graph_attr)
-
-      for n in subg['nodes']:
-         n = pd.Node(n)
-         subG.add_node(n)
-      for e in subg['edges']:
-         e = pd.Edge(e[0],e[1])
-         subG.add_edge(e)
-      G.add_subgraph(subG)
-
-   if trace: 
-      if trace['type'] == 'full': 
-         proc_ft(G, trace, styles['trace']['color'])
+   if out_format not in format_types:
+      print 'File type not supported'
+      return False
+   if job is None: job = Job()
+   start = time.time()
+   selectors = styles.selectors()
+   if selectors:
+      attrs = merge_attrs(selectors.attrs(graph), attrs)
+   if trace:
+      if trace['type'] == 'full':
+         attrs = merge_attrs(attrs, proc_ft(trace, styles['trace']['color']))
       else:
-         proc_pt(G, trace['back_edges'])
-
-   #G.write(f_out_dot,prog=layout)
-   f_out = "%s.%s" % (f_out_name,out_format)
-   if out_format == 'pdf':
-      G.write_pdf(f_out,prog=layout)
-   elif out_format == 'png':
-      G.write_png(f_out,prog=layout)
-   elif out_format == 'gif':
-      G.write_gif(f_out,prog=layout)
-   elif out_format == 'jpeg':
-      G.write_jpeg(f_out,prog=layout)
-   elif out_format == 'ps':
-      G.write_ps(f_out,prog=layout)
+         attrs = merge_attrs(attrs, proc_pt(trace['back_edges']))
+   if f_out is None: f_out = "%s.%s" % (f_out_name,out_format)
+   done = render(graph, styles, layout, out_format, f_out, cache, attrs, job)
+   job.seconds = time.time() - start
+   return done
+
+def render(graph, styles, layout, out_format, f_out, cache=None, attrs=None, job=None):
+   """
+   Runs graphviz on graph, writing the DOT text straight into its stdin.
+   If f_out is '-' the output of graphviz is read into job.output instead of written to a file.
+   With a DotCache of graph, the layout is computed once and every node and edge is pinned
+   to its position, rendered by neato -n2. So restyles and traces do not lay out the graph again.
+   """
+   if job is None: job = Job()
+   pinned = cache is not None and cache.graph is graph and cache.layout(styles, layout, job)
+   if pinned:
+      args = ['neato', '-n2']
    else:
-      print 'File type not supported'  
+      args = [layout]
+   piped = f_out == '-'
+   try:
+      if piped:
+         proc = job.start(args + ['-T%s' % out_format], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+      else:
+         proc = job.start(args + ['-T%s' % out_format, '-o', f_out], stdin=subprocess.PIPE)
+   except OSError:
+      print 'Graphviz program %s not found.' % args[0]
+      return False
+   if not proc: return False
+   if piped:                  #Read while writing, graphviz may fill the pipe before reading all input
+      reader = threading.Thread(target=lambda: setattr(job, 'output', proc.stdout.read()))
+      reader.daemon = True
+      reader.start()
+   try:
+      write_dot(proc.stdin, graph, styles, cache, attrs, pinned)
+   except IOError: pass       #Graphviz exited early, its status says why
+   proc.stdin.close()
+   start = time.time()
+   status = proc.wait()
+   if piped: reader.join()
+   job.graphviz += time.time() - start
+   if status:
+      if not job.cancelled: print 'Graphviz %s failed.' % args[0]
+      return False
+   return True
 
+def write_dot(f_out, graph, styles, cache=None, attrs=None, pinned=False):
+   """
+   Writes graph as DOT text to the file object f_out, streaming it from the subgraph dict.
+   cache  - a DotCache of graph. Nodes and edges of a subgraph are serialized once and reused
+            until the cache is invalidated. Only the style statements are written every time.
+   attrs  - subgraph key -> {node or edge: attribute dict}, as made by proc_ft and proc_pt.
+            Written inline on the statements of those elements, so only subgraphs with
+            entries are serialized again.
+   pinned - write the positions of the cached layout on every node and edge.
+   """
+   if cache is not None and cache.graph is not graph: cache = None
+   pos = cache.pos if pinned and cache is not None else {}
+   f_out.write('digraph G {\n')
+   f_out.write(dot_defaults(styles['root']))
+   keys = ['aux'] + [k for k in graph if k != 'aux']
+   for key in keys:
+      f_out.write('subgraph %s {\n' % dot_id(key))
+      f_out.write(dot_defaults(styles[key]))
+      if attrs and key in attrs:
+         f_out.write(dot_body(graph[key], pos, attrs[key]))
+      elif cache is None:
+         f_out.write(dot_body(graph[key], pos))
+      else:
+         f_out.write(cache.body(key, pinned))
+      f_out.write('}\n')
+   f_out.write('}\n')
 
-def trace(adj_list, atom):
-   """ Returns provenance trace of atom. """
-   trace = {'nodes': set(), 'back_edges':set(), 'edges': set()}
-   color_n = defaultdict(dict)
+class Graph(dict):
+   """
+   Subgraph dictionary made by build(), subgraph key -> {'nodes': set of atoms, 'edges': set of edges}.
+   Only the nodes are stored. The edges of a subgraph are read from adj_list each time they are
+   used, see Subgraph, so the provenance is held once, in the CSR arrays of the Adjacency.
+   """
+   def __init__(self):
+      dict.__init__(self)
+      self.adj_list = None
+
+   def __missing__(self, key):
+      subg = self[key] = Subgraph(self, key)
+      return subg
+
+   def edges(self, key):
+      """
+      Generator over the edges of subgraph key, those of the adjacency whose edge_pred() is key.
+      Those of a predicate are the edges between its atoms and aux atoms, in either direction.
+      """
+      if key in ('aux', 'negation') or key not in self: return   #Never the subgraph of an edge
+      adj_list = self.adj_list
+      ids, names = adj_list.atoms.ids, adj_list.atoms.names
+      if key == 'negation_out':
+         for c in self['negation']['nodes'] if 'negation' in self else ():
+            for v in adj_list.out_ids(ids[c]):
+               yield c, names[v]
+         return
+      for n in self[key]['nodes']:
+         i = ids[n]
+         for u in adj_list.in_ids(i):
+            a = names[u]
+            if a.startswith('aux'): yield a, n
+         for v in adj_list.out_ids(i):
+            a = names[v]
+            if a.startswith('aux'): yield n, a
+
+class Subgraph(dict):
+   """ Subgraph of a Graph. Its edges are made from the adjacency when read, and not kept. """
+   def __init__(self, graph, key):
+      dict.__init__(self, nodes=set())
+      self.graph = graph
+      self.key = key
+
+   def __missing__(self, kind):
+      if kind != 'edges': raise KeyError(kind)
+      return set(self.graph.edges(self.key))
+
+class NegationEdges(dict):
+   """
+   The negation_in subgraph of a graph made by build(). Its edges, from every atom of a negated
+   predicate to its negation class, are not stored but generated by negation_edges() when read.
+   Summaries and traces hold their negation_in edges in a plain subgraph.
+   """
+   def __init__(self, graph):
+      dict.__init__(self, nodes=set())
+      self.graph = graph
+
+   def __missing__(self, kind):
+      if kind != 'edges': raise KeyError(kind)
+      return set(negation_edges(self.graph))
+
+def virtual_negations(graph):
+   """ Makes the negation_in subgraph of graph a NegationEdges, if graph has negation classes. """
+   if 'negation' in graph and not isinstance(graph.get('negation_in'), NegationEdges):
+      graph['negation_in'] = NegationEdges(graph)
+
+def negation_edges(graph):
+   """ Generator over the edges from the atoms of each negated predicate to its negation class. """
+   for neg_class in graph['negation']['nodes']:
+      pred = neg_class[1:-1]
+      if pred in graph:
+         for atom in graph[pred]['nodes']:
+            yield atom, neg_class
+
+def dot_defaults(style):
+   """ Returns DOT default attribute statements for the graph, nodes and edges of a style entry. """
+   stmts = []
+   for kind, stmt in (('nodes', 'node'), ('edges', 'edge'), ('graph', 'graph')):
+      attrs = style[kind]
+      if attrs:
+         stmts.append('%s [%s];\n' % (stmt, dot_attrs(attrs)))
+   return ''.join(stmts)
+
+def dot_attrs(attrs):
+   """ Returns the DOT attribute list of a dict, without brackets. """
+   return ', '.join('%s=%s' % (k, dot_id(v)) for k,v in attrs.iteritems())
+
+def dot_id(s):
+   """ Quotes s as a DOT ID. """
+   return '"%s"' % str(s).replace('\\', '\\\\').replace('"', '\\"')
+
+def dot_body(subg, *attrs):
+   """
+   Returns the DOT node and edge statements of a subgraph.
+   attrs - {node or edge: attribute dict} maps. Attributes of later maps take precedence.
+   """
+   attrs = [a for a in attrs if a]
+   if not attrs:
+      text = ['%s;\n' % dot_id(n) for n in subg['nodes']]
+      text.extend('%s -> %s;\n' % (dot_id(u), dot_id(v)) for u,v in subg['edges'])
+      return ''.join(text)
+
+   def attr_list(x):
+      found = [a[x] for a in attrs if x in a]
+      if not found: return ''
+      if len(found) == 1: return ' [%s]' % dot_attrs(found[0])
+      merged = {}
+      for a in found: merged.update(a)
+      return ' [%s]' % dot_attrs(merged)
+
+   text = ['%s%s;\n' % (dot_id(n), attr_list(n)) for n in subg['nodes']]
+   text.extend('%s -> %s%s;\n' % (dot_id(e[0]), dot_id(e[1]), attr_list(e)) for e in subg['edges'])
+   return ''.join(text)
+
+class DotCache(object):
+   """
+   Serialized DOT text of the nodes and edges of each subgraph of one graph, for write_dot(),
+   and the graphviz layout of the graph.
+   Styles are not part of the cached text, so restyling a subgraph costs only its style statements.
+   pos        - node or edge -> {'pos': position} of the layout given by layout_key.
+   bodies     - subgraph key -> text, pinned holds the same text with positions.
+   Subgraphs changed by add_aux/remove_aux must be invalidated, which drops the layout too.
+   """
+   def __init__(self, graph):
+      self.graph = graph
+      self.bodies = {}
+      self.pinned = {}
+      self.pos = {}
+      self.layout_key = None
+
+   def body(self, key, pinned=False):
+      bodies = self.pinned if pinned else self.bodies
+      text = bodies.get(key)
+      if text is None:
+         text = bodies[key] = dot_body(self.graph[key], self.pos if pinned else None)
+      return text
+
+   def invalidate(self, keys=None):
+      """ Drops the text of subgraphs keys, or of every subgraph. """
+      if keys is None:
+         self.bodies.clear()
+      else:
+         for key in keys:
+            self.bodies.pop(key, None)
+      if keys is None or keys:
+         self.drop_layout()
+
+   def drop_layout(self):
+      self.pinned.clear()
+      self.pos = {}
+      self.layout_key = None
+
+   def layout(self, styles, layout, job):
+      """
+      Lays out the graph with graphviz program layout, unless the cached layout was made by the
+      same program with the same graph attributes. Returns False if graphviz failed.
+      job - the Job of the draw needing the layout
+      """
+      key = layout_key(styles, layout)
+      if key == self.layout_key: return True
+      self.drop_layout()
+      f_dot = StringIO()
+      write_dot(f_dot, self.graph, styles, self)
+      try:
+         proc = job.start([layout, '-Tdot'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+      except OSError:
+         return False
+      if not proc: return False
+      start = time.time()
+      out = proc.communicate(f_dot.getvalue())[0]
+      job.graphviz += time.time() - start
+      if proc.returncode: return False
+      self.pos = read_pos(out)
+      self.layout_key = key
+      return True
+
+class Job(object):
+   """
+   One draw. Another thread may cancel it, which kills its graphviz process.
+   started  - time the job was made
+   seconds  - wall time of the draw
+   graphviz - the part of it spent waiting for graphviz
+   drawn    - True once drawn by draw_all()
+   output   - output of graphviz of a draw to '-'
+   """
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.cancelled = False
+      self.drawn = False
+      self.output = None
+      self.proc = None
+      self.started = time.time()
+      self.seconds = self.graphviz = 0.0
+
+   def start(self, args, **kwargs):
+      """ Starts graphviz with args, unless cancelled. Returns the process, None if cancelled. """
+      with self.lock:
+         if self.cancelled: return None
+         self.proc = subprocess.Popen(args, **kwargs)
+         return self.proc
+
+   def cancel(self):
+      with self.lock:
+         self.cancelled = True
+         if self.proc and self.proc.poll() is None:
+            self.proc.kill()
+
+class Renderer(object):
+   """
+   Draws in a background thread, so the interpreter does not wait for graphviz.
+   Draws are debounced: a draw starts once no other was requested for delay seconds, and only
+   the latest one is drawn. A new request cancels the draw in progress.
+   report - called with a message when a draw completes.
+   """
+   def __init__(self, delay=render_delay, report=None):
+      self.delay = delay
+      self.report = report
+      self.cond = threading.Condition()
+      self.pending = None    #(args, kwargs) of the latest draw requested
+      self.stamp = 0         #Time it was requested
+      self.job = None        #Job of the draw in progress
+      self.done = None       #Job of the last completed draw
+      worker = threading.Thread(target=self.run)
+      worker.daemon = True
+      worker.start()
+
+   def draw(self, *args, **kwargs):
+      """ Requests draw(*args, **kwargs). The arguments must not change until it is drawn. """
+      with self.cond:
+         self.pending = (args, kwargs)
+         self.stamp = time.time()
+         if self.job: self.job.cancel()
+         self.cond.notify_all()
+
+   def cancel(self):
+      """ Drops the requested draw and cancels the one in progress, returning once it stopped. """
+      with self.cond:
+         self.pending = None
+         if self.job: self.job.cancel()
+         while self.job:
+            self.cond.wait()
+
+   def run(self):
+      while True:
+         with self.cond:
+            while True:
+               if self.pending is None:
+                  self.cond.wait()
+                  continue
+               wait = self.stamp + self.delay - time.time()
+               if wait <= 0: break
+               self.cond.wait(wait)
+            args, kwargs = self.pending
+            self.pending = None
+            job = self.job = Job()
+
+         try:
+            done = draw(*args, job=job, **kwargs)
+         finally:
+            with self.cond:
+               self.job = None
+               self.cond.notify_all()
+         if done:
+            self.done = job
+            if self.report:
+               self.report('Drew %s.%s in %.1fs (graphviz %.1fs)' % (f_out_name, args[3], job.seconds, job.graphviz))
+
+def draw_all(jobs, workers):
+   """
+   Draws many graphs with up to workers graphviz processes running at a time.
+   jobs - iterable of (Job, args, kwargs) of draw(). It is consumed as workers become free, so it
+          can make each graph when it is needed. The arguments must not change until drawn.
+   Each Job records whether it was drawn in drawn, and its times as in draw().
+   """
+   queue = Queue.Queue(2 * workers)
+   def work():
+      while True:
+         item = queue.get()
+         if item is None: return
+         job, args, kwargs = item
+         job.drawn = draw(*args, job=job, **kwargs)
+
+   threads = [threading.Thread(target=work) for i in xrange(workers)]
+   for t in threads:
+      t.daemon = True
+      t.start()
+   try:
+      for item in jobs:
+         queue.put(item)
+   finally:
+      for t in threads: queue.put(None)
+      for t in threads: t.join()
+
+def layout_key(styles, layout):
+   """ Returns what the layout of a graph depends on besides its structure: the layout program and graph attributes. """
+   attrs = []
+   for key,style in styles.iteritems():
+      g = style.get('graph') if isinstance(style, dict) else None
+      if g: attrs.append((key, tuple(sorted(g.iteritems()))))
+   return layout, tuple(sorted(attrs))
+
+def read_pos(dot):
+   """ Returns node or edge -> {'pos': position} of the DOT text of a graphviz layout. """
+   pos = {}
+   dot = dot.replace('\\\n', '')       #Graphviz breaks long lines inside strings
+   for m in dot_stmt_re.finditer(dot):
+      u, v, attrs = m.groups()
+      p = pos_re.search(attrs)
+      if not p: continue
+      u = dot_unquote(u)
+      if v is None:
+         pos[u] = {'pos': p.group(1)}
+      else:
+         pos[(u, dot_unquote(v))] = {'pos': p.group(1)}
+   return pos
+
+def dot_unquote(s):
+   if s.startswith('"'):
+      return re.sub(r'\\(.)', r'\1', s[1:-1])
+   return s
+
+def trace(adj_list, atom, cache=None):
+   """
+   Returns provenance trace of atom.
+   cache - a TraceCache shared between traces of the same graph. Parts of the provenance
+           already computed by earlier traces are reused instead of searched again.
+   """
+   if atom not in adj_list: return None
+   if cache is None: cache = TraceCache()
+   v = adj_list.atoms.ids[atom]
+   if v not in cache.index:
+      DFS(adj_list, [v], cache)
+   return cache.get(v, adj_list.atoms.names)
+
+def trace_all(adj_list, atoms, cache=None):
+   """
+   Returns the union of the provenance traces of atoms, found by one search that visits each
+   atom once, however many of the traces it is in. None if no atom is in the graph.
+   """
+   atoms = [a for a in atoms if a in adj_list]
+   if not atoms: return None
+   if len(atoms) == 1: return trace(adj_list, atoms[0], cache)
+   if cache is None: cache = TraceCache()
+   ids = adj_list.atoms.ids
+   run = DFS(adj_list, [ids[a] for a in atoms], cache)
+   nodes, eu, ev, eb = cache.runs[run]
+   return cache.slice(run, 0, len(nodes), 0, len(eu), adj_list.atoms.names)
+
+def DFS(adj_list, roots, cache):
+   """
+   Reverse depth first search from atom IDs roots, one after the other. u -> v
+   Atoms visited from an earlier root are not searched again, so the run holds the union of
+   the provenance of roots. Returns the number of the run.
+   Iterative, so the depth of the provenance is not limited by the recursion limit. Visits atoms
+   and edges in the same order as the recursive search did, so it finds the same backedges (cycles).
+   Every atom whose search did not reach an atom visited before it is recorded in cache.
+   When the search enters an atom recorded by an earlier trace, whose provenance is still
+   unvisited, the recorded provenance is copied instead of searched.
+   """
+   run = len(cache.runs)
+   nodes, eu, ev, eb = array('i'), array('i'), array('i'), array('b')
+   cache.runs.append((nodes, eu, ev, eb))
+   pre = {}          #Atom ID -> preorder number. Visited atoms.
+   grey = set()      #Atoms on the stack
+   fail = {}         #Run -> position of a visited atom in it, checked first by splice()
+
+   def splice(v):
+      """ Copies the recorded provenance of v into this run if none of it is visited yet. """
+      r, lo, hi, elo, ehi = cache.index[v]
+      r_nodes, r_eu, r_ev, r_eb = cache.runs[r]
+      p = fail.get(r)
+      if p is not None and lo <= p < hi: return False
+      for p in xrange(lo, hi):
+         if r_nodes[p] in pre:
+            fail[r] = p
+            return False
+      for u in r_nodes[lo:hi]:
+         pre[u] = len(nodes)
+         nodes.append(u)
+      eu.extend(r_eu[elo:ehi])
+      ev.extend(r_ev[elo:ehi])
+      eb.extend(r_eb[elo:ehi])
+      return True
+
+   def enter(v):
+      """ Returns a new stack frame for v: [atom, in-edges, next in-edge, low, first edge]. """
+      pre[v] = len(nodes)
+      nodes.append(v)
+      grey.add(v)
+      return [v, adj_list.in_ids(v), 0, pre[v], len(eu)]
+
+   for root in roots:
+      if root in pre or (root in cache.index and splice(root)): continue
+      stack = [enter(root)]
+      while stack:
+         frame = stack[-1]
+         v, in_edge, i = frame[0], frame[1], frame[2]
+         if i < len(in_edge):
+            u = in_edge[i]
+            frame[2] = i + 1
+            eu.append(u)
+            ev.append(v)
+            if u not in pre:
+               eb.append(0)
+               if not (u in cache.index and splice(u)):
+                  stack.append(enter(u))
+            elif u in grey:
+               eb.append(1)
+               frame[3] = min(frame[3], pre[u])
+            else:
+               eb.append(0)
+               frame[3] = min(frame[3], pre[u])
+            continue
+
+         stack.pop()
+         grey.discard(v)
+         low = frame[3]
+         if low >= pre[v]:    #Search of v stayed inside its own subtree
+            cache.index[v] = (run, pre[v], len(nodes), frame[4], len(eu))
+         if stack:
+            stack[-1][3] = min(stack[-1][3], low)
+   return run
+
+
+def witnesses(adj_list, atom, k=1):
+   """
+   Returns up to k derivations of atom, shallowest first, as (depth, trace) pairs.
+   The derivations differ in the rule instance, the aux atom, deriving atom. Below it each is a
+   derivation tree of minimal depth, one aux atom per derived atom, that does not use atom again.
+   Facts and negated atoms are leaves, a fact alone is its own witness of depth 0.
+   None if atom is not in the graph.
+   The search is depth bounded, doubling the bound until k derivations are found and then
+   bisecting for their depth, so it stays within the depth of the witnesses instead of visiting
+   the whole provenance.
+   """
    if atom not in adj_list: return None
-   DFS(adj_list, atom, trace, color_n) 
-   return trace 
-
-def DFS(adj_list, v, trace, color_n):
-   """ Reverse depth first search. u -> v Returns set traversed by search and set of backedges (cycles). """
-   v_pred = predicate(v)
-   color_n[v] = 'grey'
-   trace['nodes'].add(v)
-   for u in adj_list[v].in_edge:
-      if not color_n[u]:
-         trace['edges'].add((u,v))
-         DFS(adj_list, u, trace, color_n)
-      elif color_n[u] == 'grey':
-         trace['back_edges'].add((u,v))
+   v = adj_list.atoms.ids[atom]
+   prover = Prover(adj_list, v)
+   if prover.leaf(v):
+      return [(0, prover.tree(v, None))]
+   found, pending = [], list(adj_list.in_ids(v))
+   low, bound = 0, 1           #Derivations still pending are deeper than low
+   while pending and len(found) < k and low <= len(adj_list):
+      for aux in list(pending):
+         body = adj_list.in_ids(aux)
+         if prover.prove_all(body, bound - 1):
+            lo, hi = low, bound
+            while hi - lo > 1:
+               mid = (lo + hi) // 2
+               if prover.prove_all(body, mid - 1):
+                  hi = mid
+               else:
+                  lo = mid
+            found.append((hi, aux))
+            pending.remove(aux)
+      low, bound = bound, bound * 2
+   return [(depth, prover.tree(v, aux)) for depth, aux in sorted(found)[:k]]
+
+def witness_all(adj_list, atoms, k=1):
+   """ Returns the union of the k shallowest witnesses of each of atoms, see witnesses(). None if no atom is in the graph. """
+   union = None
+   for atom in atoms:
+      for depth, w in witnesses(adj_list, atom, k) or ():
+         if union is None:
+            union = w
+         else:
+            for key in union:
+               union[key] |= w[key]
+   return union
+
+def bounded(adj_list, atoms, depth=None, nodes=None):
+   """
+   Returns the provenance trace of atoms cut off depth derivation steps below them, or once it holds
+   nodes atoms, whichever comes first. Breadth first over the in-edges, so the nearest provenance is kept.
+   None if no atom is in the graph.
+   """
+   ids, names = adj_list.atoms.ids, adj_list.atoms.names
+   level = dict((ids[a], 0) for a in atoms if a in adj_list)
+   if not level: return None
+   trace = {'nodes': set(), 'back_edges':set(), 'edges': set()}
+   queue = deque(level)
+   while queue:
+      v = queue.popleft()
+      trace['nodes'].add(names[v])
+      l = level[v]
+      if depth is not None and l >= depth and not names[v].startswith('aux'): continue
+      for u in adj_list.in_ids(v):
+         if u not in level:
+            if nodes is not None and len(level) >= nodes: continue
+            level[u] = l if names[u].startswith('aux') else l + 1
+            queue.append(u)
+         trace['edges'].add((names[u], names[v]))
+   return trace
+
+
+class Prover(object):
+   """
+   Depth bounded proofs of atoms of one graph, for witnesses().
+   proof  - atom ID -> (height, aux atom ID) of the lowest proof found so far, aux None for leaves.
+   failed - atom ID -> the largest bound under which the atom was found to have no proof.
+   Both stay valid as the bound grows, so each round of deepening only searches what is new.
+   Proofs never use the atom ID root, so witnesses of root are trees. Proofs are lower than the
+   atoms using them, so no other atom repeats either.
+   """
+   def __init__(self, adj_list, root=None):
+      self.adj_list = adj_list
+      self.root = root
+      self.proof = {}
+      self.failed = {}
+
+   def leaf(self, v):
+      """ Facts have no in-edges. Negated atoms hold by the absence of the atom, not by a derivation. """
+      return not self.adj_list.in_ids(v) or self.adj_list.atoms.names[v].startswith('not ')
+
+   def prove_all(self, atoms, r):
+      """ True if every atom ID of atoms has a proof no higher than r. """
+      for u in atoms:
+         if self.prove(u, r) is None: return False
+      return True
+
+   def prove(self, v, r):
+      """
+      Returns the height of a proof of atom ID v no higher than r, None if there is none.
+      Iterative, searches are generators that yield the atoms they need proved.
+      """
+      stack = [self.search(v, r)]
+      result = None
+      while stack:
+         request = stack[-1].send(result)
+         if request[0] is None:
+            stack.pop()
+            result = request[1]
+         else:
+            stack.append(self.search(*request))
+            result = None
+      return result
+
+   def search(self, v, r):
+      """ Generator proving atom ID v within height r. Yields (atom, bound) requests, then (None, height). """
+      proof = self.proof.get(v)
+      if v == self.root:
+         yield None, None
+      elif proof is not None and proof[0] <= r:
+         yield None, proof[0]
+      elif self.failed.get(v, -1) >= r:
+         yield None, None
+      elif self.leaf(v):
+         self.proof[v] = (0, None)
+         yield None, 0
       else:
-         trace['edges'].add((u,v))
-   color_n[v] = 'black'
-   return 
+         for aux in (self.adj_list.in_ids(v) if r > 0 else ()):
+            height = 0
+            for u in self.adj_list.in_ids(aux):
+               h = yield u, r - 1
+               if h is None: break
+               height = max(height, h)
+            else:
+               self.proof[v] = (height + 1, aux)
+               yield None, height + 1
+               return
+         self.failed[v] = r
+         yield None, None
+
+   def tree(self, v, aux):
+      """ Returns the derivation tree of atom ID v through aux, following the recorded proofs below it. """
+      names = self.adj_list.atoms.names
+      trace = {'nodes': set([names[v]]), 'back_edges':set(), 'edges': set()}
+      stack, seen = [(v, aux)], set([v])
+      while stack:
+         v, aux = stack.pop()
+         if aux is None: continue
+         trace['nodes'].add(names[aux])
+         trace['edges'].add((names[aux], names[v]))
+         for u in self.adj_list.in_ids(aux):
+            trace['nodes'].add(names[u])
+            trace['edges'].add((names[u], names[aux]))
+            if u not in seen:
+               seen.add(u)
+               stack.append((u, self.proof[u][1]))
+      return trace
+
 
-def proc_ft(graph, trace, color):
-   """ Colors the full trace. """
+class TraceCache(object):
+   """
+   Provenance computed by earlier traces of one graph.
+   runs holds one log per DFS: the atom IDs visited in preorder and the edges searched, with
+   a backedge flag. The provenance of an atom is a contiguous slice of a run, which index maps
+   atom ID -> (run, first node, last node, first edge, last edge).
+   Must be replaced when the graph changes.
+   """
+   def __init__(self):
+      self.runs = []
+      self.index = {}
+
+   def get(self, v, names):
+      """ Returns the recorded trace of atom ID v. """
+      r, lo, hi, elo, ehi = self.index[v]
+      return self.slice(r, lo, hi, elo, ehi, names)
+
+   def slice(self, r, lo, hi, elo, ehi, names):
+      """ Returns the trace made of nodes lo:hi and edges elo:ehi of run r. """
+      nodes, eu, ev, eb = self.runs[r]
+      trace = {'nodes': set(), 'back_edges':set(), 'edges': set()}
+      trace['nodes'].update(names[u] for u in nodes[lo:hi])
+      for i in xrange(elo, ehi):
+         if eb[i]:
+            trace['back_edges'].add((names[eu[i]], names[ev[i]]))
+         else:
+            trace['edges'].add((names[eu[i]], names[ev[i]]))
+      return trace
+
+class Negations(object):
+   """
+   Adjacency of a graph with the in-edges of negation, for tracing. build() stores none, as they
+   would be an edge from every atom of a negated predicate. Each is found in the AtomIndex instead.
+   The in-edges of the negation class {pred} are all atoms of pred.
+   With rules, the precise mode: a negated atom not pred(args) has in-edges from the atoms of pred
+   that agree with args where the rules using it bind the argument in the head, instead of an
+   in-edge from the negation class. They are what holds for that head instead of pred(args),
+   found by one lookup in the index.
+   Otherwise behaves as adj_list.
+   """
+   def __init__(self, adj_list, index, rules=None):
+      self.adj_list = adj_list
+      self.index = index
+      self.classes = {}     #Predicate position of a negation class -> the negated predicate
+      self.negated = {}     #Predicate position of a negated predicate -> (predicate, positions bound by heads)
+      for p, pred in enumerate(index.preds):
+         if pred.startswith('{'): self.classes[p] = pred[1:-1]
+      bound = {}
+      for mapping in (rules or {}).itervalues():
+         head = set(mapping[0][1])
+         for pred, args in mapping[1:]:
+            if pred.startswith('not '):
+               b = set(j for j, a in enumerate(args) if a in head)
+               bound[pred] = bound[pred] & b if pred in bound else b
+      for pred, b in bound.iteritems():
+         if pred in index.pred_ids:
+            self.negated[index.pred_ids[pred]] = (pred[4:], b)
+
+   def __getattr__(self, name):
+      return getattr(self.adj_list, name)
+
+   def __contains__(self, atom):
+      return atom in self.adj_list
+
+   def __len__(self):
+      return len(self.adj_list)
+
+   def in_ids(self, i):
+      """ Returns IDs of the atoms with an edge into atom ID i, negation edges included. """
+      pred_of = self.index.pred_of
+      p = pred_of[i] if i < len(pred_of) else -1
+      if p in self.negated:
+         pred, bound = self.negated[p]
+         args = arguments(self.adj_list.atoms.names[i])
+         return self.index.find('%s(%s)' % (pred, ','.join(a if j in bound else '_' for j, a in enumerate(args))))
+      if p in self.classes:
+         return self.index.find(self.classes[p])
+      return self.adj_list.in_ids(i)
+
+
+class ReachIndex(object):
+   """
+   Strongly connected components of the provenance graph, condensed into a DAG, with a
+   reachability index over the DAG. Built once per graph, answers dependency queries and
+   full traces without searching the graph again.
+   comp   - atom ID -> SCC ID. Tarjan numbers SCCs so an atom's provenance never has a larger SCC ID.
+   back   - backedges (u, v) of one DFS over the whole graph. Removing them breaks every cycle.
+   labels - interval labels (lo, post) of k postorder traversals of the DAG. If SCC b is in the
+            provenance of SCC a, every interval of b lies inside the interval of a.
+   """
+   def __init__(self, adj_list, k=2):
+      self.adj_list = adj_list
+      self.comp, self.back = scc(adj_list)
+      n, nc = len(adj_list), max(self.comp) + 1 if len(adj_list) else 0
+      self.members_ptr, self.members_idx = csr(nc, self.comp, array('i', xrange(n)))
+
+      src, dst = array('i'), array('i')      #Condensed DAG, c -> SCCs in the provenance of c
+      for c in xrange(nc):
+         deps = set()
+         for v in self.members(c):
+            deps.update(self.comp[u] for u in adj_list.in_ids(v))
+         deps.discard(c)
+         for d in sorted(deps):
+            src.append(c)
+            dst.append(d)
+      self.dag_ptr, self.dag_idx = csr(nc, src, dst)
+      self.labels = [self.label(order) for order in range(k)]
+
+   def members(self, c):
+      """ Returns IDs of the atoms in SCC c. """
+      return self.members_idx[self.members_ptr[c]:self.members_ptr[c+1]]
+
+   def deps(self, c):
+      """ Returns the SCCs c has an edge from. """
+      return self.dag_idx[self.dag_ptr[c]:self.dag_ptr[c+1]]
+
+   def label(self, order):
+      """ Postorder interval labels of the DAG. Odd orders visit children in reverse. """
+      nc = len(self.dag_ptr) - 1
+      lo, post = array('i', [0]) * nc, array('i', [0]) * nc
+      seen = bytearray(nc)
+      t = 0
+      for r in xrange(nc - 1, -1, -1):
+         if seen[r]: continue
+         seen[r] = 1
+         work = [[r, self.children(r, order), 0, nc]]
+         while work:
+            f = work[-1]
+            c, ch, i = f[0], f[1], f[2]
+            if i < len(ch):
+               f[2] = i + 1
+               d = ch[i]
+               if not seen[d]:
+                  seen[d] = 1
+                  work.append([d, self.children(d, order), 0, nc])
+               else:
+                  f[3] = min(f[3], lo[d])
+               continue
+            work.pop()
+            post[c] = t
+            lo[c] = min(f[3], t)
+            t += 1
+            if work: work[-1][3] = min(work[-1][3], lo[c])
+      return lo, post
+
+   def children(self, c, order):
+      d = self.deps(c)
+      if order % 2: d.reverse()
+      return d
+
+   def reach(self, a, b):
+      """ True if SCC b is in the provenance of SCC a. """
+      if a == b: return True
+      if b > a: return False
+      for lo, post in self.labels:
+         if not (lo[a] <= lo[b] and post[b] <= post[a]): return False
+      seen = set([a])
+      work = [a]
+      while work:               #Labels only rule out, search the DAG for the rest, pruned by the labels.
+         c = work.pop()
+         for d in self.deps(c):
+            if d == b: return True
+            if d < b or d in seen: continue
+            seen.add(d)
+            if all(lo[d] <= lo[b] and post[b] <= post[d] for lo, post in self.labels):
+               work.append(d)
+      return False
+
+   def depends(self, a, b):
+      """ True if atom a depends on atom b, ie. b is in the provenance of a. None if either is unknown. """
+      ids = self.adj_list.atoms.ids
+      if a not in ids or b not in ids: return None
+      return self.reach(self.comp[ids[a]], self.comp[ids[b]])
+
+   def trace(self, atoms):
+      """
+      Returns provenance trace of an atom, or the union of the traces of a list of atoms, by
+      expanding the SCCs in their provenance.
+      Backedges are those of the index, so they break every cycle but can differ from the
+      backedges of a DFS started at atom.
+      """
+      if isinstance(atoms, basestring): atoms = [atoms]
+      ids = self.adj_list.atoms.ids
+      seen = set(self.comp[ids[a]] for a in atoms if a in ids)
+      if not seen: return None
+      names = self.adj_list.atoms.names
+      work = list(seen)
+      while work:
+         for d in self.deps(work.pop()):
+            if d not in seen:
+               seen.add(d)
+               work.append(d)
+
+      trace = {'nodes': set(), 'back_edges':set(), 'edges': set()}
+      for c in seen:
+         for v in self.members(c):
+            trace['nodes'].add(names[v])
+            for u in self.adj_list.in_ids(v):
+               if (u, v) in self.back:
+                  trace['back_edges'].add((names[u], names[v]))
+               else:
+                  trace['edges'].add((names[u], names[v]))
+      return trace
+
+
+def scc(adj_list):
+   """
+   Tarjan's algorithm over the in-edges of adj_list, iterative.
+   Returns the SCC ID of every atom, and the backedges (u, v) found by the search.
+   """
+   n = len(adj_list)
+   index, low = array('i', [-1]) * n, array('i', [0]) * n
+   comp = array('i', [-1]) * n
+   on_stack, grey = bytearray(n), bytearray(n)
+   stack, back = [], set()
+   counter = n_comp = 0
+   for r in xrange(n):
+      if index[r] != -1: continue
+      index[r] = low[r] = counter
+      counter += 1
+      stack.append(r)
+      on_stack[r] = grey[r] = 1
+      work = [[r, adj_list.in_ids(r), 0]]
+      while work:
+         f = work[-1]
+         v, in_edge, i = f
+         if i < len(in_edge):
+            u = in_edge[i]
+            f[2] = i + 1
+            if index[u] == -1:
+               index[u] = low[u] = counter
+               counter += 1
+               stack.append(u)
+               on_stack[u] = grey[u] = 1
+               work.append([u, adj_list.in_ids(u), 0])
+            else:
+               if grey[u]: back.add((u, v))
+               if on_stack[u] and index[u] < low[v]: low[v] = index[u]
+            continue
+
+         work.pop()
+         grey[v] = 0
+         if work and low[v] < low[work[-1][0]]:
+            low[work[-1][0]] = low[v]
+         if low[v] == index[v]:
+            while True:
+               w = stack.pop()
+               on_stack[w] = 0
+               comp[w] = n_comp
+               if w == v: break
+            n_comp += 1
+   return comp, back
+
+def proc_ft(trace, color):
+   """ Returns the attributes coloring the full trace, by subgraph. """
+   attrs = defaultdict(dict)
    for n in trace['nodes']:
-      pred = '"%s"' % node_pred(n)
-      n = '"%s"' % n
-      n_ref = graph.get_subgraph(pred)[0].get_node(n)[0]
-      n_ref.set_fontcolor(color)
+      attrs[node_pred(n)][n] = {'fontcolor': color}
    for e in trace['edges']:
-      pred = '"%s"' % edge_pred(e)
-      e = ('"%s"' % e[0], '"%s"' % e[1])
-      e_ref = graph.get_subgraph(pred)[0].get_edge(e)[0]
-      e_ref.set_color(color)
+      attrs[edge_pred(e)][e] = {'color': color}
    for e in trace['back_edges']:
-      pred = '"%s"' % edge_pred(e)
-      e = ('"%s"' % e[0], '"%s"' % e[1])
-      e_ref = graph.get_subgraph(pred)[0].get_edge(e)[0]
-      e_ref.set_color(color)
-      e_ref.set_style('dashed')
-
-def proc_pt(graph, be):
-   """ Styles backedges """
+      attrs[edge_pred(e)][e] = {'color': color, 'style': 'dashed'}
+   return attrs
+
+def proc_pt(be):
+   """ Returns the attributes styling backedges, by subgraph. """
+   attrs = defaultdict(dict)
    for e in be:
-      pred = '"%s"' % edge_pred(e)
-      e = ('"%s"' % e[0], '"%s"' % e[1])
-      e_ref = graph.get_subgraph(pred)[0].get_edge(e)[0]
-      e_ref.set_style('dashed')
-      e_ref.set_constraint('false')
+      attrs[edge_pred(e)][e] = {'style': 'dashed', 'constraint': 'false'}
+   return attrs
+
+def merge_attrs(attrs, over):
+   """ Returns the attributes of attrs updated with those of over, both by subgraph as from proc_ft. """
+   if not attrs: return over
+   if not over: return attrs
+   merged = defaultdict(dict)
+   for m in (attrs, over):
+      for key, elems in m.iteritems():
+         for x, a in elems.iteritems():
+            merged[key].setdefault(x, {}).update(a)
+   return merged
+
+def summarize(graph, rules, expanded=(), keep=()):
+   """
+   Returns a summary of graph for drawing, and the attributes of its elements, as (graph, attrs).
+   Each predicate subgraph not in expanded is drawn as one node, labelled with its number of atoms.
+   A derivation of a collapsed atom becomes an edge from each of its body atoms to the head,
+   labelled with the number of derivations between the two. Atoms of expanded predicates, atoms in
+   keep, eg. the nodes of a trace, and negation classes are drawn as they are, with the aux atoms
+   deriving them.
+   rules - the rule map of graph
+   """
+   keep = set(keep)
+   summary = defaultdict(lambda:{'nodes':set(), 'edges':set()})
+   attrs = defaultdict(dict)
+   shown = lambda key: key in expanded or key == 'negation'
+
+   for key, subg in graph.iteritems():
+      if key == 'aux' or not subg['nodes']: continue
+      if shown(key):
+         summary[key]['nodes'].update(subg['nodes'])
+         continue
+      kept = [n for n in keep if n in subg['nodes']]
+      summary[key]['nodes'].update(kept)
+      if len(subg['nodes']) > len(kept):
+         node = '[%s]' % key
+         summary[key]['nodes'].add(node)
+         attrs[key][node] = {'label': '%s\n%d' % (key, len(subg['nodes']) - len(kept)), 'shape': 'box'}
+
+   def rep(atom):
+      key = node_pred(atom)
+      return atom if shown(key) or atom in keep else '[%s]' % key
+
+   weights = defaultdict(int)
+   for aux in graph['aux']['nodes']:
+      pred, paren, args = aux.partition('(')
+      aux, (h_pred, head), body = project(rules, (pred, args[:-1]))
+      h = rep(head)
+      if h == head or aux in keep:
+         summary['aux']['nodes'].add(aux)
+         weights[(aux, head)] += 1
+         for b_pred, b in body:
+            weights[(rep(b), aux)] += 1
+      else:
+         for b_pred, b in body:
+            weights[(rep(b), h)] += 1
+   for u, v in chain(graph['negation_in']['edges'], graph['negation_out']['edges']):
+      weights[(rep(u), rep(v))] += 1
+
+   for e, n in weights.iteritems():
+      key = edge_pred(tuple(x[1:-1] if x.startswith('[') else x for x in e))
+      summary[key]['edges'].add(e)
+      if n > 1:
+         attrs[key][e] = {'label': str(n), 'penwidth': '%.1f' % (1 + math.log(n, 2)), 'weight': str(n)}
+   return summary, attrs
 
 def pt_graph(trace):
    """ Returns trace only graph. """
    graph = defaultdict(lambda:{'nodes':set(), 'edges':set()})
-   nodes = [node_pred(n) for n in trace['nodes']]
-   graph[pred]['nodes'].add(nodes)
-   edges = [edge_pred(e) for e in trace['edges']]
-   graph[pred]['edges'].add(edges)
-   edges = [edge_pred(e) for e in trace['back_edges']]
-   graph[pred]['edges'].add(edges)
+   for n in trace['nodes']:
+      graph[node_pred(n)]['nodes'].add(n)
+   for e in chain(trace['edges'], trace['back_edges']):
+      graph[edge_pred(e)]['edges'].add(e)
    return graph
 
+def parse_pattern(pattern):
+   """ Returns the predicate and the list of terms of an atom or pattern, None for terms if it has no arguments. """
+   pattern = pattern.strip()
+   pred, paren, args = pattern.partition('(')
+   if not paren: return pattern, None
+   return pred, [t.strip() for t in args[:-1].split(',')]
+
+def arguments(atom):
+   """ Returns the arguments of an atom. """
+   pred, paren, args = atom.partition('(')
+   return args[:-1].split(',') if paren else []
+
+def is_var(term):
+   """ Variables start with an upper case letter or an underscore. """
+   return term[:1].isupper() or term[:1] == '_'
+
+def matches(terms, args):
+   """ True if the arguments args match terms. Variables other than _ must match the same value everywhere. """
+   if len(terms) != len(args): return False
+   binding = {}
+   for t, a in izip(terms, args):
+      if t == '_': continue
+      if is_var(t):
+         if binding.setdefault(t, a) != a: return False
+      elif t != a:
+         return False
+   return True
+
 def predicate(atom):
    """ Returns the predicate of an atom. """
-   m = re.search('([^(]*)(.+)', atom)
-   return m.group(1)
+   return atom.partition('(')[0]
 
 def edge_pred(e):
    """ Returns subgraph predicate of an edge. """
-   if re.match('{', e[0]):
+   if e[0].startswith('{'):
       return 'negation_out'
-   if re.match('{', e[1]):
+   if e[1].startswith('{') or e[1].startswith('not '):
       return 'negation_in'
-   if re.match('aux', e[0]):
+   if e[0].startswith('aux'):
       return predicate(e[1])
    else:
       return predicate(e[0])
 
 def node_pred(n):
    """ Returns predicate of node. """
-   if re.match('aux', n):
+   if n.startswith('aux'):
       return 'aux'
-   if re.match('{', n):
+   if n.startswith('{'):
       return 'negation'
    else:
       return predicate(n)
 
-def trace_color(styles):
-   """ Colors all nodes and edges in the trace. Returns new style dict. """
-   new_styles = deepcopy(styles)
-   new_styles['trace']['color'] = t_color
-   for key,subg in new_styles.iteritems():
+def trace_color(styles, color=t_color):
+   """ Returns styles with the overlay of a full trace: the trace in color, nodes and edges of the rest in nt_color. """
+   layer = {'trace': {'color': color}}
+   for key,style in styles.iteritems():
       if key == 'trace': continue
-      if 'fontcolor' in subg['nodes'].iterkeys():
-         subg['nodes']['fontcolor'] = nt_color  
-      if 'color' in subg['edges'].iterkeys():
-         subg['edges']['color'] = nt_color   
-   return new_styles
+      over = {}
+      if 'fontcolor' in style['nodes']:
+         over['nodes'] = {'fontcolor': nt_color}
+      if 'color' in style['edges']:
+         over['edges'] = {'color': nt_color}
+      if over: layer[key] = over
+   return styles.overlay(layer)
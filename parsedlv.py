@@ -8,9 +8,13 @@
    This is a datalog parser. 
    It transforms datalog rules by introducing intermediary rules that can then be used to render provenance.
    Its output will be the new auxiliary rules, and a map which can be used to parse the output from dlv.
+   Use parse() to parse in-process. The lexer and LALR tables are generated once, into lextab.py and
+   parsetab.py next to this module, and read from there afterwards. lextab.py is checked against the
+   token rules on import and regenerated if they changed, yacc checks parsetab.py against the grammar.
 """
 
 # Tokenizer for the Datalog language
+import os
 import sys
 import ply.lex as lex
 import pickle
@@ -58,7 +62,7 @@ t_ignore  = ' \t'
 
 # Error handling rule
 def t_error(t):
-    sys.stderr.write("Illegal character '%s'" % t.value[0])
+    errors.append("Illegal character '%s' on line %d" % (t.value[0], t.lexer.lineno))
     t.lexer.skip(1)
 
 #Comments
@@ -69,15 +73,50 @@ def t_comment(t):
 #------------------------------------------------------------------------------------------
 # Parser
 
-lexer = lex.lex()
+tab_dir = os.path.dirname(os.path.abspath(__file__))   # lextab.py and parsetab.py are cached here
+
+def token_rules():
+    '''Returns the regular expression of each token rule, by rule name.'''
+    rules = dict()
+    for name, value in globals().items():
+        if name.startswith('t_') and name not in ('t_ignore', 't_error'):
+            rules[name] = value if isinstance(value, str) else value.__doc__
+    return rules
+
+def lextab_stale(path):
+    '''True if the cached lexer table path was generated from other tokens or token rules.
+       With optimize=1 lex reads the table without checking it against the rules.'''
+    if not os.path.exists(path): return False
+    table = dict()
+    try:
+        execfile(path, table)
+        regex = ''.join(r for r, names in table['_lexstatere']['INITIAL'])
+        if table['_lextokens'] != set(tokens) or table['_lexstateignore']['INITIAL'] != t_ignore:
+            return True
+    except Exception:
+        return True
+    rules = token_rules()
+    if regex.count('(?P<') != len(rules) or [n for n, r in rules.iteritems() if '(?P<%s>%s)' % (n, r) not in regex]:
+        return True
+    funcs = [f.__name__ for f in sorted((f for f in globals().values() if callable(f) and f.__name__ in rules),
+                                        key=lambda f: f.func_code.co_firstlineno)]
+    return sorted(funcs, key=lambda n: regex.index('(?P<%s>' % n)) != funcs    # Function rules match in definition order
+
+lextab_path = os.path.join(tab_dir, 'lextab.py')
+if lextab_stale(lextab_path):             # Regenerated by lex below
+    for stale in (lextab_path, lextab_path + 'c'):
+        if os.path.exists(stale): os.remove(stale)
+    sys.modules.pop('lextab', None)
+lexer = lex.lex(optimize=1, lextab='lextab', outputdir=tab_dir)
 import ply.yacc as yacc
 rule_map = dict()
+rule_list = []  # Rule objects, in program order
+errors = []     # Errors of the last parse
 aux_index = 0   # To Distinguish different derivations of same predicate
 
 def p_program(p):
     'program : rule_plural'
     p[0] = p[1]
-    print p[0]
 
 def p_rule_plural(p):
     'rule_plural : rule_single rule_plural'
@@ -93,6 +132,7 @@ def p_rule_single(p):
     c = Rule(p[1], p[3], aux_index)
     aux_index = aux_index + 1
     rule_map.update(c.rule_map)
+    rule_list.append(c)
     p[0] = c.__str__()
 
 def p_args_plural(p):
@@ -127,10 +167,55 @@ def p_atom(p):
     p[0] = Atom(p[1],p[3])
 
 def p_error(p):
-    print "Syntax error in input!"
+    if p:
+        errors.append("Syntax error at '%s' on line %d" % (p.value, p.lineno))
+    else:
+        errors.append("Syntax error at end of input")
 
-# Build the parser
-parser = yacc.yacc()
-data = open(sys.argv[1]).read()
-result = parser.parse(data)
-pickle.dump(rule_map, open('parse_map.p', 'wb'))
+# Build the parser. The tables are regenerated only when the grammar changes, without writing parser.out.
+parser = yacc.yacc(debug=False, tabmodule='parsetab', outputdir=tab_dir)
+
+def parse(data):
+    '''Parses datalog rules. Returns the list of Rule objects and the map from aux predicates to head/body.
+       Raises ValueError listing the errors if the rules do not parse.'''
+    global aux_index
+    aux_index = 0
+    del rule_list[:]
+    del errors[:]
+    rule_map.clear()
+    lexer.lineno = 1
+    parser.parse(data, lexer=lexer)
+    if errors:
+        raise ValueError('\n'.join(errors))
+    return list(rule_list), dict(rule_map)
+
+def relevant(rules, goal):
+    '''Returns the rules the predicate goal depends on, positively or negatively, in program order.'''
+    heads = dict()
+    for r in rules:
+        heads.setdefault(r.head.predicate, []).append(r)
+    needed, work = set([goal]), [goal]
+    while work:
+        for r in heads.get(work.pop(), ()):
+            for atom in r.body:
+                pred = re.sub('^not ', '', atom.predicate)
+                if pred not in needed:
+                    needed.add(pred)
+                    work.append(pred)
+    return [r for r in rules if r.head.predicate in needed]
+
+def rule_map_of(rules):
+    '''Returns the map from aux predicates to head/body of rules.'''
+    r_map = dict()
+    for r in rules:
+        r_map.update(r.rule_map)
+    return r_map
+
+if __name__ == '__main__':
+    try:
+        rules, r_map = parse(open(sys.argv[1]).read())
+    except ValueError as e:
+        sys.stderr.write('%s\n' % e)
+        sys.exit(1)
+    if rules: print '\n'.join(map(str, rules))
+    pickle.dump(r_map, open('parse_map.p', 'wb'))
@@ -0,0 +1,186 @@
+#======================================================================
+# GDDB: Graphical Datalog Debugger
+# Author: Jade Koskela <jtkoskela@ucdavis.edu>
+# http://github.com/jkoskela/gddb
+# HTTP server for GDDB
+#======================================================================
+"""
+This module serves a gddb session over HTTP, so a model is built once and queried by many clients.
+Endpoints take their arguments in the query string and answer JSON, or the drawing of a trace.
+  /find?pattern=tc(1,_)[&pattern=...][&limit=N]  - atoms matching the patterns
+  /count[?pattern=...]                            - atoms matching each pattern, or of every predicate
+  /trace?atom=tc(1,2)[&atom=...][options]         - nodes, edges and back edges of the trace
+  /render?atom=tc(1,2)[&atom=...][options][&format=svg][&layout=dot][&color=red] - drawing of the trace
+Options are those of the trace command: partial, precise, scc, witness, k, depth and nodes, eg. witness=1&k=2.
+/render draws partial traces unless partial=0, in SVG by default. Drawings are cached by atoms, options,
+styles and layout.
+"""
+
+import json
+import time
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+from collections import OrderedDict
+import graphdlv
+
+cache_size = 256     #Drawings kept by the render cache
+flags = {'partial': '-p', 'precise': '-x', 'scc': '-s', 'witness': '-w'}
+counts = {'k': '-k', 'depth': '-d', 'nodes': '-n'}
+content_types = {'svg': 'image/svg+xml', 'png': 'image/png', 'gif': 'image/gif', 'jpeg': 'image/jpeg',
+                 'pdf': 'application/pdf', 'ps': 'application/postscript'}
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+   """
+   HTTP server over a GraphCMD session, serving each request in a thread.
+   Reading the model takes lock, graphviz runs outside it, so drawings are made concurrently.
+   session - GraphCMD, not traced. Its styles and layout are those of /render.
+   address - (host, port), port 0 picks a free one, see server_address.
+   """
+   daemon_threads = True
+   allow_reuse_address = True
+
+   def __init__(self, session, address=('127.0.0.1', 0)):
+      BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+      self.session = session
+      self.styles_key = json.dumps(session.styles.layers, sort_keys=True)
+      self.lock = threading.Lock()
+      self.layouts = {}        #Layout program -> DotCache of the main graph laid out by it, None if it failed
+      self.renders = RenderCache(cache_size)
+
+   def get_(self, query):
+      return reply({'endpoints': ['/find', '/count', '/trace', '/render'], 'atoms': len(self.session.adj_list)})
+
+   def get_find(self, query):
+      patterns = atoms_of(query, 'pattern')
+      limit = number(query, 'limit')
+      with self.lock:
+         atoms = self.session.match_atoms(patterns)
+      return reply({'atoms': atoms[:limit], 'count': len(atoms)})
+
+   def get_count(self, query):
+      patterns = query.get('pattern')
+      with self.lock:
+         index = self.session.atom_index()
+         if patterns:
+            found = dict((p, index.count(p)) for p in patterns)
+         else:
+            found = dict(index.counts())
+      return reply({'counts': found})
+
+   def get_trace(self, query):
+      patterns, opts = atoms_of(query, 'atom'), self.options(query)
+      with self.lock:
+         trace = self.session.trace_of(self.session.match_atoms(patterns), opts)
+      if not trace: return reply({'error': 'Atom not found.'}, 404)
+      return reply(dict((k, sorted(trace[k])) for k in ('nodes', 'edges', 'back_edges')))
+
+   def get_render(self, query):
+      patterns, opts = atoms_of(query, 'atom'), self.options(query)
+      if 'partial' not in query: opts['p'] = True        #Fragments by default
+      out_format = last(query, 'format', 'svg')
+      layout = last(query, 'layout', self.session.layout)
+      color = last(query, 'color')
+      if out_format not in graphdlv.format_types or layout not in graphdlv.layout_types:
+         raise ValueError('Format or layout not supported.')
+      key = (tuple(patterns), tuple(sorted(opts.iteritems())), color, layout, out_format, self.styles_key)
+      headers = {'Content-Type': content_types[out_format]}
+      data = self.renders.get(key)
+      if data is not None:
+         headers['X-Cache'] = 'hit'
+         return 200, headers, data
+
+      start = time.time()
+      with self.lock:
+         session = self.session
+         trace = session.trace_of(session.match_atoms(patterns), opts)
+         if not trace: return reply({'error': 'Atom not found.'}, 404)
+         graph, styles = session.traced(trace, opts, color)
+         graph, attrs, cache = session.drawing(graph, trace)
+         if cache is not None and graph is session.subg_dict: cache = self.laid_out(styles, layout)
+      job = graphdlv.Job()
+      if not graphdlv.draw(graph, styles, layout, out_format, trace, cache, job, attrs, '-'):
+         return reply({'error': 'Graphviz %s failed.' % layout}, 500)
+      self.renders.put(key, job.output)
+      headers['X-Cache'] = 'miss'
+      headers['X-Render-Seconds'] = '%.3f' % (time.time() - start)
+      return 200, headers, job.output
+
+   def options(self, query):
+      """ Returns the trace options of query, by letter as GraphCMD.trace_options makes them. """
+      words = [opt for name, opt in flags.iteritems() if last(query, name, '0') not in ('0', '')]
+      for name, opt in counts.iteritems():
+         if name in query: words.extend([opt, last(query, name)])
+      opts, color = self.session.trace_options(words)
+      if opts is None: raise ValueError('Invalid trace options.')
+      return opts
+
+   def laid_out(self, styles, layout):
+      """ Returns the DotCache of the main graph pinned to its layout by program layout, None if graphviz failed. """
+      if layout not in self.layouts:
+         cache = graphdlv.DotCache(self.session.subg_dict)
+         self.layouts[layout] = cache if cache.layout(styles, layout, graphdlv.Job()) else None
+      return self.layouts[layout]
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+   """ Dispatches GET /name to the get_name method of the server. """
+   protocol_version = 'HTTP/1.1'
+
+   def do_GET(self):
+      url = urlparse.urlparse(self.path)
+      endpoint = getattr(self.server, 'get_' + url.path.strip('/'), None)
+      if endpoint is None:
+         status, headers, body = reply({'error': 'No endpoint %s.' % url.path}, 404)
+      else:
+         try:
+            status, headers, body = endpoint(urlparse.parse_qs(url.query))
+         except ValueError as e:
+            status, headers, body = reply({'error': str(e)}, 400)
+      self.send_response(status)
+      for k, v in sorted(headers.iteritems()):
+         self.send_header(k, v)
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+
+class RenderCache(object):
+   """ The size most recently used drawings, by key. Shared by the threads of the server. """
+   def __init__(self, size):
+      self.size = size
+      self.items = OrderedDict()
+      self.lock = threading.Lock()
+
+   def get(self, key):
+      with self.lock:
+         data = self.items.pop(key, None)
+         if data is not None: self.items[key] = data
+         return data
+
+   def put(self, key, data):
+      with self.lock:
+         self.items[key] = data
+         while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+def reply(obj, status=200):
+   """ Returns the status, headers and body of a JSON response. """
+   return status, {'Content-Type': 'application/json'}, json.dumps(obj)
+
+def last(query, name, default=None):
+   """ Returns the last value of argument name of a parsed query string. """
+   return query[name][-1] if name in query else default
+
+def atoms_of(query, name):
+   """ Returns the values of argument name, raising ValueError if there are none. """
+   if not query.get(name): raise ValueError('Missing %s.' % name)
+   return query[name]
+
+def number(query, name):
+   """ Returns argument name as an int, None if it is not given. """
+   value = last(query, name)
+   if value is None: return None
+   if not value.isdigit(): raise ValueError('%s must be a number.' % name)
+   return int(value)
@@ -0,0 +1,205 @@
+#======================================================================
+# GDDB: Graphical Datalog Debugger
+# Author: Jade Koskela <jtkoskela@ucdavis.edu>
+# http://github.com/jkoskela/gddb
+# Session snapshots for GDDB
+#======================================================================
+"""
+This module saves a gddb session to a binary snapshot and restores it: the graph, adjacency, atom
+index and rule map, with the state of the interpreter such as styles, trace, layout and format.
+A snapshot is a JSON header followed by native arrays, each aligned to 8 bytes, so they are read
+straight from a memory map. Restoring copies the arrays once and builds no atom or edge by parsing.
+Subgraph sets are made from their arrays the first time they are used.
+"""
+
+import sys
+import json
+import mmap
+import struct
+from array import array
+from collections import defaultdict
+from itertools import izip, imap
+import graphdlv
+
+magic = 'GDDBSNP1'
+align = 8
+
+def save(f_name, graph, adj_list, rules, state):
+   """
+   Writes a snapshot of graph, adj_list and its AtomIndex, and the rule map rules to f_name.
+   state - JSON serializable state of the session, returned as it is by load().
+   """
+   atoms = adj_list.atoms
+   ids, names = atoms.ids, atoms.names
+   sections = [('names', '\n'.join(names))]
+   sections.extend(izip(('in_ptr', 'in_idx', 'out_ptr', 'out_idx'), csr_rows(adj_list)))
+
+   keys = [key for key in graph if not isinstance(graph[key], graphdlv.NegationEdges)]
+   for key in keys:
+      subg = graph[key]
+      src, dst = array('i'), array('i')
+      for u, v in subg['edges']:
+         src.append(ids[u])
+         dst.append(ids[v])
+      sections.append(('nodes/' + key, array('i', (ids[n] for n in subg['nodes']))))
+      sections.append(('src/' + key, src))
+      sections.append(('dst/' + key, dst))
+
+   index = adj_list.index
+   if index is not None:
+      members, member_ptr = array('i'), array('l', [0])
+      for m in index.members:
+         members.extend(m)
+         member_ptr.append(len(members))
+      sections.extend([('pred_of', index.pred_of), ('members', members), ('member_ptr', member_ptr)])
+      index = {'preds': index.preds, 'sizes': index.sizes}
+
+   offsets, offset = {}, 0
+   for name, data in sections:
+      code = data.typecode if isinstance(data, array) else 'c'
+      offsets[name] = (offset, code, len(data))
+      offset += padded(len(data) * (data.itemsize if code != 'c' else 1))
+   header = json.dumps({'byteorder': sys.byteorder, 'itemsize': {'i': array('i').itemsize, 'l': array('l').itemsize},
+                        'atoms': len(names), 'keys': keys, 'sections': offsets, 'index': index,
+                        'rules': rules, 'state': state})
+
+   f = open(f_name, 'wb')
+   try:
+      f.write(magic)
+      f.write(struct.pack('<Q', len(header)))
+      f.write(header)
+      f.write('\0' * (padded(f.tell()) - f.tell()))
+      for name, data in sections:
+         start = f.tell()
+         if isinstance(data, array):
+            data.tofile(f)
+         else:
+            f.write(data)
+         f.write('\0' * (padded(f.tell() - start) - (f.tell() - start)))
+   finally:
+      f.close()
+
+def padded(n):
+   return (n + align - 1) // align * align
+
+def csr_rows(adj_list):
+   """ Returns (in_ptr, in_idx, out_ptr, out_idx) of the adjacency, as in Adjacency. """
+   n = len(adj_list.atoms)
+   if not (getattr(adj_list, 'in_ptr', None) is None or adj_list.in_rows or adj_list.out_rows or adj_list.n != n):
+      return adj_list.in_ptr, adj_list.in_idx, adj_list.out_ptr, adj_list.out_idx
+   rows = []
+   for ids in (adj_list.in_ids, adj_list.out_ids):
+      ptr, idx = array('l', [0]), array('i')
+      for i in xrange(n):
+         idx.extend(ids(i))
+         ptr.append(len(idx))
+      rows.extend((ptr, idx))
+   return rows
+
+def is_snapshot(f_name):
+   """ True if f_name is a snapshot. """
+   try:
+      return open(f_name, 'rb').read(len(magic)) == magic
+   except IOError:
+      return False
+
+def load(f_name):
+   """
+   Opens the snapshot f_name. Returns the subgraph dictionary, adjacency, rule map and session state.
+   Raises ValueError if it is not a snapshot of this platform.
+   """
+   snap = Snapshot(f_name)
+   header = snap.header
+   names = str(snap.section('names')).split('\n') if header['atoms'] else []
+   atoms = graphdlv.AtomTable()
+   atoms.names = names
+   atoms.ids = dict(izip(names, xrange(len(names))))
+
+   adj_list = SnapshotAdjacency(atoms, *[snap.array(k) for k in ('in_ptr', 'in_idx', 'out_ptr', 'out_idx')])
+   if header['index'] is not None:
+      index = adj_list.index = graphdlv.AtomIndex(atoms, {})
+      index.preds, index.sizes = header['index']['preds'], header['index']['sizes']
+      index.pred_ids = dict((pred, p) for p, pred in enumerate(index.preds))
+      index.pred_of = snap.array('pred_of')
+      members, ptr = snap.array('members'), snap.array('member_ptr')
+      index.members = [members[ptr[p]:ptr[p+1]] for p in xrange(len(index.preds))]
+      index.listed = array('b', [0]) * len(index.pred_of)
+      for i in members:
+         index.listed[i] = 1
+
+   graph = defaultdict(lambda:{'nodes':set(), 'edges':set()})
+   for key in header['keys']:
+      graph[key] = SnapshotSubgraph(snap, key, names)
+   graphdlv.virtual_negations(graph)
+   rules = dict((aux, [(pred, args) for pred, args in mapping]) for aux, mapping in header['rules'].iteritems())
+   return graph, adj_list, rules, header['state']
+
+
+class Snapshot(object):
+   """ Header and memory map of a snapshot file. Sections are read from the map. """
+   def __init__(self, f_name):
+      f = open(f_name, 'rb')
+      try:
+         if f.read(len(magic)) != magic: raise ValueError('%s is not a snapshot.' % f_name)
+         self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      finally:
+         f.close()
+      start = len(magic) + 8
+      (size,) = struct.unpack('<Q', self.map[len(magic):start])
+      self.header = json.loads(self.map[start:start + size], object_hook=strings)
+      self.base = padded(start + size)
+      if self.header['byteorder'] != sys.byteorder or \
+         self.header['itemsize'] != {'i': array('i').itemsize, 'l': array('l').itemsize}:
+         raise ValueError('%s was saved on another platform.' % f_name)
+
+   def section(self, name):
+      """ Returns a buffer over the bytes of section name. """
+      offset, code, n = self.header['sections'][name]
+      size = n if code == 'c' else n * array(code).itemsize
+      return buffer(self.map, self.base + offset, size)
+
+   def array(self, name):
+      """ Returns section name as an array. """
+      a = array(self.header['sections'][name][1])
+      a.fromstring(self.section(name))
+      return a
+
+def strings(d):
+   """ JSON object hook, encodes the strings of d back to str as the rest of gddb uses them. """
+   return dict((utf8(k), utf8(v)) for k, v in d.iteritems())
+
+def utf8(x):
+   if isinstance(x, unicode): return x.encode('utf-8')
+   if isinstance(x, list): return [utf8(v) for v in x]
+   return x
+
+
+class SnapshotSubgraph(dict):
+   """ Subgraph whose node and edge sets are made from the arrays of a snapshot on first use. """
+   def __init__(self, snap, key, names):
+      dict.__init__(self)
+      self.snap = snap
+      self.key = key
+      self.names = names
+
+   def __missing__(self, kind):
+      name = self.names.__getitem__
+      if kind == 'nodes':
+         s = set(imap(name, self.snap.array('nodes/' + self.key)))
+      elif kind == 'edges':
+         s = set(izip(imap(name, self.snap.array('src/' + self.key)), imap(name, self.snap.array('dst/' + self.key))))
+      else:
+         raise KeyError(kind)
+      self[kind] = s
+      return s
+
+
+class SnapshotAdjacency(graphdlv.Adjacency):
+   """ Adjacency restored from the CSR arrays of a snapshot, instead of built from an edge list. """
+   def __init__(self, atoms, in_ptr, in_idx, out_ptr, out_idx):
+      self.atoms = atoms
+      self.n = len(in_ptr) - 1
+      self.in_ptr, self.in_idx = in_ptr, in_idx
+      self.out_ptr, self.out_idx = out_ptr, out_idx
+      self.in_rows, self.out_rows = {}, {}
+      self.index = None
@@ -0,0 +1,317 @@
+#======================================================================
+# GDDB: Graphical Datalog Debugger
+# Author: Jade Koskela <jtkoskela@ucdavis.edu>
+# http://github.com/jkoskela/gddb
+# Persistent store for built graphs
+#======================================================================
+"""
+This module saves the graph built by graphdlv into an SQLite database, so later sessions can open
+the model without the parse map and dlv output.
+Opening a store reads nothing but its predicates and rule map. Subgraphs, atoms and adjacency rows
+are read from the database the first time they are used, so are the atoms of each predicate of the
+atom index.
+Stores carry the version of their schema in user_version. Opening an older store migrates it.
+"""
+
+import os
+import sqlite3
+from array import array
+from collections import defaultdict
+import graphdlv
+
+version = 2     #Schema version. 0: negation in-edges stored, 1: nodes without atom_pred
+schema = '''
+create table atoms (id integer primary key, name text not null);
+create table preds (name text primary key);
+create table nodes (pred text not null, atom integer not null, atom_pred text not null);
+create table edges (pred text not null, src integer not null, dst integer not null);
+create table rules (aux text not null, pos integer not null, pred text not null, args text not null);
+'''
+indexes = '''
+create unique index atoms_name on atoms(name);
+create index nodes_pred on nodes(pred);
+create index nodes_atom_pred on nodes(atom_pred, atom);
+create index nodes_atom on nodes(atom);
+create index edges_pred on edges(pred);
+create index edges_src on edges(src);
+create index edges_dst on edges(dst);
+'''
+
+def save(f_name, graph, adj_list, rules):
+   """
+   Writes a graph and its rule map to the store f_name, replacing it if it exists.
+   Edges are written in the order of the in-edges of adj_list, so traces of the stored
+   graph visit atoms in the same order.
+   """
+   if os.path.exists(f_name): os.remove(f_name)
+   db = sqlite3.connect(f_name)
+   db.text_factory = str
+   db.execute('pragma journal_mode = off')
+   db.execute('pragma synchronous = off')
+   db.executescript(schema)
+   db.execute('pragma user_version = %d' % version)
+   atoms = adj_list.atoms
+   ids = atoms.ids
+   graph = dict((key, subg) for key, subg in graph.iteritems() if not isinstance(subg, graphdlv.NegationEdges))
+
+   db.executemany('insert into atoms values (?, ?)', ((i, atoms.names[i]) for i in xrange(len(atoms))))
+   db.executemany('insert into preds values (?)', ((key,) for key in graph))
+   for key,subg in graph.iteritems():
+      db.executemany('insert into nodes values (?, ?, ?)', ((key, ids[n], graphdlv.predicate(n)) for n in subg['nodes']))
+
+   names = atoms.names
+   def edges():
+      for v in xrange(len(atoms)):
+         seen = set()
+         for u in adj_list.in_ids(v):
+            if u in seen: continue
+            seen.add(u)
+            yield graphdlv.edge_pred((names[u], names[v])), u, v
+   db.executemany('insert into edges values (?, ?, ?)', edges())
+
+   db.executemany('insert into rules values (?, ?, ?, ?)',
+                  ((aux, i, pred, ','.join(str(a) for a in args))
+                   for aux, mapping in rules.iteritems() for i, (pred, args) in enumerate(mapping)))
+   db.executescript(indexes)
+   db.commit()
+   db.close()
+
+def is_store(f_name):
+   """ True if f_name is an SQLite database. """
+   try:
+      return open(f_name, 'rb').read(16) == 'SQLite format 3\0'
+   except IOError:
+      return False
+
+def load(f_name):
+   """
+   Opens the store f_name. Returns the subgraph dictionary, adjacency and rule map, as
+   build() and parsedlv would have made them. The first two read the database on demand.
+   Raises ValueError if the store was written by a newer version.
+   """
+   db = sqlite3.connect(f_name, check_same_thread=False)
+   db.text_factory = str
+   migrate(db, f_name)
+   rules = defaultdict(list)
+   for aux, pred, args in db.execute('select aux, pred, args from rules order by aux, pos'):
+      rules[aux].append((pred, [int(a) for a in args.split(',') if a]))
+
+   graph = defaultdict(lambda:{'nodes':set(), 'edges':set()})
+   for (key,) in db.execute('select name from preds'):
+      graph[key] = StoredSubgraph(db, key)
+   graphdlv.virtual_negations(graph)
+   return graph, StoredAdjacency(db), dict(rules)
+
+def migrate(db, f_name):
+   """ Brings the store of connection db up to the current schema version. """
+   (found,) = db.execute('pragma user_version').fetchone()
+   if found > version: raise ValueError('%s was written by a newer version of gddb.' % f_name)
+   if found < 1:       #In-edges of negation classes are generated, see graphdlv.NegationEdges
+      db.execute("delete from edges where pred = 'negation_in'")
+      db.execute("delete from preds where name = 'negation_in'")
+   if found < 2:       #Nodes carry the predicate of their atom, for StoredIndex
+      db.create_function('predicate', 1, graphdlv.predicate)
+      db.execute('alter table nodes add column atom_pred text')
+      db.execute('update nodes set atom_pred = (select predicate(name) from atoms where id = nodes.atom)')
+      db.execute('create index nodes_atom_pred on nodes(atom_pred, atom)')
+      db.execute('create index nodes_atom on nodes(atom)')
+   if found < version:
+      db.execute('pragma user_version = %d' % version)
+      db.commit()
+
+
+class StoredSubgraph(dict):
+   """ Subgraph whose node and edge sets are read from the store on first use. """
+   def __init__(self, db, key):
+      dict.__init__(self)
+      self.db = db
+      self.key = key
+
+   def __missing__(self, kind):
+      if kind == 'nodes':
+         rows = self.db.execute('select a.name from nodes n join atoms a on a.id = n.atom'
+                                ' where n.pred = ?', (self.key,))
+         s = set(name for (name,) in rows)
+      elif kind == 'edges':
+         rows = self.db.execute('select a.name, b.name from edges e join atoms a on a.id = e.src'
+                                ' join atoms b on b.id = e.dst where e.pred = ?', (self.key,))
+         s = set(rows)
+      else:
+         raise KeyError(kind)
+      self[kind] = s
+      return s
+
+
+class StoredIndex(graphdlv.AtomIndex):
+   """
+   AtomIndex of a store. Predicates and their sizes are read when it is made, the atoms of a
+   predicate by one indexed query the first time it is used. Negation classes and negated
+   predicates, which graphdlv.Negations looks up while tracing, are read at once.
+   Ground atoms are found without reading their predicate.
+   """
+   def __init__(self, db, atoms):
+      self.db = db
+      self.atoms = atoms
+      self.preds, self.sizes = [], []
+      for pred, size in db.execute('select atom_pred, count(*) from nodes group by atom_pred'):
+         self.preds.append(pred)
+         self.sizes.append(size)
+      self.pred_ids = dict((pred, p) for p, pred in enumerate(self.preds))
+      self.pred_of, self.listed = array('i', [-1]) * len(atoms), array('b', [0]) * len(atoms)
+      self.members, self.args = StoredMembers(self, len(self.preds)), {}
+      for p, pred in enumerate(self.preds):
+         if pred.startswith('{') or pred.startswith('not '): self.members[p]
+
+   def read(self, p):
+      """ Returns the IDs of the atoms of predicate position p in the store, marking them in pred_of. """
+      ids = array('i', (i for (i,) in self.db.execute('select atom from nodes where atom_pred = ? order by atom',
+                                                       (self.preds[p],))))
+      for i in ids:
+         self.pred_of[i] = p
+         self.listed[i] = 1
+      return ids
+
+   def load(self, i, atom=None):
+      """ Reads the predicate of atom ID i, so changes to it are made to its atoms. """
+      p = self.pred_ids.get(graphdlv.predicate(atom or self.atoms.names[i]))
+      if p is not None: self.members[p]
+
+   def add(self, i, atom=None):
+      self.load(i, atom)
+      graphdlv.AtomIndex.add(self, i, atom)
+
+   def remove(self, i):
+      self.load(i)
+      graphdlv.AtomIndex.remove(self, i)
+
+   def find(self, pattern):
+      pred, terms = graphdlv.parse_pattern(pattern)
+      p = self.pred_ids.get(pred)
+      if p is None or terms is None or [t for t in terms if graphdlv.is_var(t)] or self.members.loaded(p):
+         return graphdlv.AtomIndex.find(self, pattern)
+      i = self.atoms.ids.get('%s(%s)' % (pred, ','.join(terms)))       #Ground atom, not changed since opening
+      if i is None or not self.db.execute('select 1 from nodes where atom = ?', (i,)).fetchone(): return []
+      return [i]
+
+
+class StoredMembers(list):
+   """ AtomIndex.members of a StoredIndex. The atoms of a predicate are read from the store on first use. """
+   def __init__(self, index, n):
+      list.__init__(self, [None] * n)
+      self.index = index
+
+   def loaded(self, p):
+      return list.__getitem__(self, p) is not None
+
+   def __getitem__(self, p):
+      ids = list.__getitem__(self, p)
+      if ids is None:
+         ids = self.index.read(p)
+         self[p] = ids
+      return ids
+
+   def __iter__(self):
+      for p in xrange(len(self)):
+         yield self[p]
+
+
+class StoredIds(object):
+   """ Atom -> ID of a store, looked up on demand. Atoms interned after opening are kept in memory. """
+   def __init__(self, db):
+      self.db = db
+      self.found = {}
+      self.new = {}
+
+   def get(self, atom, default=None):
+      i = self.new.get(atom)
+      if i is None: i = self.found.get(atom)
+      if i is None:
+         row = self.db.execute('select id from atoms where name = ?', (atom,)).fetchone()
+         if row is None: return default
+         i = self.found[atom] = row[0]
+      return i
+
+   def __getitem__(self, atom):
+      i = self.get(atom)
+      if i is None: raise KeyError(atom)
+      return i
+
+   def __setitem__(self, atom, i):
+      self.new[atom] = i
+
+   def __contains__(self, atom):
+      return self.get(atom) is not None
+
+
+class StoredNames(object):
+   """ ID -> atom of a store, read on demand. Atoms interned after opening are kept in memory. """
+   def __init__(self, db):
+      self.db = db
+      self.n = db.execute('select count(*) from atoms').fetchone()[0]
+      self.found = {}
+      self.new = []
+
+   def __getitem__(self, i):
+      if i >= self.n: return self.new[i - self.n]
+      name = self.found.get(i)
+      if name is None:
+         name = self.found[i] = self.db.execute('select name from atoms where id = ?', (i,)).fetchone()[0]
+      return name
+
+   def append(self, atom):
+      self.new.append(atom)
+
+   def __len__(self):
+      return self.n + len(self.new)
+
+   def __iter__(self):
+      for (name,) in self.db.execute('select name from atoms order by id'):
+         yield name
+      for name in self.new:
+         yield name
+
+
+class StoredAdjacency(graphdlv.Adjacency):
+   """
+   Adjacency whose rows are read from the store on first use, instead of held in CSR arrays.
+   Rows changed by add_edge/remove_edge are kept in in_rows/out_rows, as in Adjacency.
+   index is a StoredIndex, made the first time it is used.
+   """
+   def __init__(self, db):
+      self.db = db
+      self.atoms = graphdlv.AtomTable()
+      self.atoms.ids, self.atoms.names = StoredIds(db), StoredNames(db)
+      self.n = self.atoms.names.n
+      self.in_rows, self.out_rows = {}, {}
+      self.in_read, self.out_read = {}, {}
+      self.index = None
+
+   @property
+   def index(self):
+      if self.atom_index is None: self.atom_index = StoredIndex(self.db, self.atoms)
+      return self.atom_index
+
+   @index.setter
+   def index(self, index):
+      self.atom_index = index
+
+   def in_ids(self, i):
+      row = self.in_rows.get(i)
+      if row is not None: return row
+      return self.read(self.in_read, 'select src from edges where dst = ? order by rowid', i)
+
+   def out_ids(self, i):
+      row = self.out_rows.get(i)
+      if row is not None: return row
+      return self.read(self.out_read, 'select dst from edges where src = ? order by rowid', i)
+
+   def read(self, rows, query, i):
+      row = rows.get(i)
+      if row is None:
+         if i >= self.n: return ()
+         row = rows[i] = array('i', (j for (j,) in self.db.execute(query, (i,))))
+      return row
+
+   def compact(self):
+      """ Changed rows stay in memory, the store is not written. """
+      pass
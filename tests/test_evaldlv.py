@@ -0,0 +1,65 @@
+import os
+import sys
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import parsedlv
+import evaldlv
+import graphdlv
+
+def tc_rules():
+   rules, rule_map = parsedlv.parse(open(os.path.join(root, 'sample_input', 'tc-rules.dlv')).read())
+   return rules
+
+class UpdateTest(unittest.TestCase):
+   def evaluator(self, facts):
+      ev = evaldlv.Evaluator(tc_rules(), facts)
+      list(ev.run())
+      return ev
+
+   def test_retract_fact_on_cycle(self):
+      ev = self.evaluator([('e', ('1', '1'))])
+      ev.insert([('tc', ('1', '9'))])
+      added, removed = ev.delete([('tc', ('1', '9'))])
+      self.assertEqual(added, [])
+      self.assertNotEqual(removed, [])
+      self.assertNotIn(('1', '9'), ev.db['tc'])
+      self.assertEqual(ev.db['tc'].tuples, self.evaluator([('e', ('1', '1'))]).db['tc'].tuples)
+
+   def test_retract_derivable_fact(self):
+      ev = self.evaluator([('e', ('1', '2')), ('tc', ('1', '2'))])
+      self.assertEqual(ev.delete([('tc', ('1', '2'))]), ([], []))
+      self.assertIn(('1', '2'), ev.db['tc'])
+      self.assertNotIn(('1', '2'), ev.edb['tc'])
+
+class GoalTest(unittest.TestCase):
+   programs = [('tc(X,Y) :- e(X,Y).\n'
+                'tc(X,Y) :- e(X,Z), tc(Z,Y).\n',
+                [('e', ('1', '2')), ('e', ('2', '3')), ('e', ('3', '1')), ('e', ('4', '5'))],
+                [('tc', ['1', 'Y']), ('tc', ['X', '5']), ('tc', None)]),
+               ('b(X,Y) :- a(X,Z), c(Y).\n'
+                'd(X) :- b(X,Y), not e(Y).\n'
+                'e(Y) :- c(Y), a(Y,Y).\n',
+                [('a', ('1', '2')), ('a', ('2', '2')), ('a', ('3', '1')), ('c', ('2',)), ('c', ('3',))],
+                [('b', ['X', '2']), ('d', ['1']), ('d', ['X'])])]
+
+   def test_goal_aux(self):
+      """ Goal aux tuples are in the full model and include the trace of every goal atom. """
+      for text, facts, goals in self.programs:
+         rules, rule_map = parsedlv.parse(text)
+         full = set(evaldlv.Evaluator(rules, facts).run())
+         graph, adj_list = graphdlv.build(rule_map, full)
+         provenance = graphdlv.Negations(adj_list, adj_list.index)
+         for goal in goals:
+            found = set(evaldlv.Evaluator(rules, facts, goal).run())
+            self.assertTrue(found <= full, goal)
+            pattern = goal[0] if goal[1] is None else '%s(%s)' % (goal[0], ','.join(goal[1]))
+            atoms = adj_list.index.match(pattern)
+            self.assertTrue(atoms, goal)
+            trace = graphdlv.trace_all(provenance, atoms)
+            needed = set(graphdlv.aux_re.match(n).groups() for n in trace['nodes'] if n.startswith('aux'))
+            self.assertTrue(needed <= found, (goal, needed - found))
+
+if __name__ == '__main__':
+   unittest.main()
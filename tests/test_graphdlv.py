@@ -0,0 +1,186 @@
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import multiprocessing
+from cStringIO import StringIO
+from collections import defaultdict
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import parsedlv
+import evaldlv
+import graphdlv
+import storedlv
+import bench
+
+def student():
+   """ Returns the graph, adjacency and rule map of the sample student program. """
+   sample = os.path.join(root, 'sample_input')
+   rules, rule_map = parsedlv.parse(open(os.path.join(sample, 'student_rules.dlv')).read())
+   facts = evaldlv.read_facts(os.path.join(sample, 'student_facts.dlv'))
+   graph, adj_list = graphdlv.build(rule_map, evaldlv.Evaluator(rules, facts).run())
+   return graph, adj_list, rule_map
+
+def dot_edges(graph, attrs=None):
+   """ Returns subgraph key -> edge statements of the DOT text of graph, in order. """
+   f = StringIO()
+   graphdlv.write_dot(f, graph, graphdlv.read_styles(None), attrs=attrs)
+   edges, key = defaultdict(list), None
+   for line in f.getvalue().split('\n'):
+      if line.startswith('subgraph '):
+         key = line.split('"')[1]
+      elif ' -> ' in line:
+         edges[key].append(line.split(' [')[0].rstrip(';'))
+   return edges
+
+class AtomIndexTest(unittest.TestCase):
+   def setUp(self):
+      self.atoms = graphdlv.AtomTable()
+      for atom in ('tc(1,2)', 'tc(1,3)', 'tc(2,3)', 'e(1,2)'):
+         self.atoms.intern(atom)
+      self.index = graphdlv.AtomIndex(self.atoms)
+
+   def test_find(self):
+      self.assertEqual(self.index.match('tc(1,_)'), ['tc(1,2)', 'tc(1,3)'])
+      self.assertEqual(self.index.match('tc(X,X)'), [])
+      self.assertEqual(self.index.count('tc'), 3)
+      self.assertEqual(self.index.find('f'), [])
+
+   def test_readd(self):
+      i = self.atoms.ids['tc(1,2)']
+      self.index.match('tc(1,_)')       #Builds the argument index
+      for n in xrange(2):
+         self.index.remove(i)
+         self.assertEqual(self.index.match('tc'), ['tc(1,3)', 'tc(2,3)'])
+         self.index.add(i)
+      self.assertEqual(sorted(self.index.find('tc')), [0, 1, 2])
+      self.assertEqual(list(self.index.members[self.index.pred_ids['tc']]), [0, 1, 2])
+      self.assertEqual(self.index.match('tc(1,_)'), ['tc(1,2)', 'tc(1,3)'])
+      self.assertEqual(self.index.count('tc'), 3)
+
+   def test_add_removed_before_arg_index(self):
+      i = self.atoms.ids['tc(1,2)']
+      self.index.remove(i)
+      self.index.match('tc(1,_)')
+      self.index.add(i)
+      self.assertEqual(self.index.match('tc(_,2)'), ['tc(1,2)'])
+      self.assertEqual(len(self.index.arg_index(self.index.pred_ids['tc'])[1]['2']), 1)
+
+class GraphTest(unittest.TestCase):
+   def expected(self, rule_map, model):
+      """ Returns subgraph key -> edges of the derivations of model, by their rules. """
+      edges = defaultdict(set)
+      for g in model:
+         aux, (pred, head), body = graphdlv.project(rule_map, g)
+         edges[pred].add((aux, head))
+         for pred, atom in body:
+            edges[pred].add((atom, aux))
+            if pred.startswith('not '): edges['negation_out'].add(('{%s}' % pred[4:], atom))
+      return edges
+
+   def check(self, graph, edges):
+      for key in set(graph) | set(edges):
+         if key != 'negation_in': self.assertEqual(graph[key]['edges'], edges[key], key)
+         self.assertNotIn('edges', dict.keys(graph[key]))
+
+   def test_edges(self):
+      graph, adj_list, rule_map = student()
+      sample = os.path.join(root, 'sample_input')
+      rules, rule_map = parsedlv.parse(open(os.path.join(sample, 'student_rules.dlv')).read())
+      model = list(evaldlv.Evaluator(rules, evaldlv.read_facts(os.path.join(sample, 'student_facts.dlv'))).run())
+      self.check(graph, self.expected(rule_map, model))
+
+   def test_update(self):
+      rules, rule_map = parsedlv.parse(open(os.path.join(root, 'sample_input', 'tc-rules.dlv')).read())
+      ev = evaldlv.Evaluator(rules, evaldlv.read_facts(os.path.join(root, 'sample_input', 'tc-facts.dlv')))
+      graph, adj_list = graphdlv.build(rule_map, ev.run())
+      for added, removed in (ev.insert([('e', ('5', '6'))]), ev.delete([('e', ('4', '2'))])):
+         for g in removed: graphdlv.remove_aux(graph, adj_list, rule_map, g)
+         for g in added: graphdlv.add_aux(graph, adj_list, rule_map, g)
+      model = [(pred, ','.join(t)) for pred, rel in ev.aux.iteritems() for t in rel.tuples]
+      self.check(graph, self.expected(rule_map, model))
+
+class ParallelBuildTest(unittest.TestCase):
+   def setUp(self):
+      self.saved = graphdlv.shard_size, multiprocessing.cpu_count
+      graphdlv.shard_size = 101                   #Many shards, sharing atoms and negation_out edges
+      multiprocessing.cpu_count = lambda: 2       #Use the pool on one CPU too
+
+   def tearDown(self):
+      graphdlv.shard_size, multiprocessing.cpu_count = self.saved
+
+   def test_same_as_serial(self):
+      program, facts = bench.negation(40, 5)
+      rules, rule_map = parsedlv.parse(program)
+      model = list(evaldlv.Evaluator(rules, facts).run())
+      graph, adj_list = graphdlv.build(rule_map, model)
+      for dlv_output in (model, iter(model)):
+         p_graph, p_adj_list = graphdlv.build(rule_map, dlv_output, 2)
+         self.assertEqual(p_adj_list.atoms.names, adj_list.atoms.names)
+         self.assertEqual((p_adj_list.in_ptr, p_adj_list.in_idx), (adj_list.in_ptr, adj_list.in_idx))
+         self.assertEqual((p_adj_list.out_ptr, p_adj_list.out_idx), (adj_list.out_ptr, adj_list.out_idx))
+         self.assertEqual(set(p_graph), set(graph))
+         for key in graph:
+            self.assertEqual(p_graph[key]['nodes'], graph[key]['nodes'], key)
+            self.assertEqual(p_graph[key]['edges'], graph[key]['edges'], key)
+
+class NegationEdgesTest(unittest.TestCase):
+   def setUp(self):
+      self.graph, self.adj_list, self.rules = student()
+
+   def test_main_graph(self):
+      edges = dot_edges(self.graph)
+      negated = [p[4:] for p in self.graph if p.startswith('not ')]
+      self.assertEqual(len(edges['negation_in']), sum(len(self.graph[p]['nodes']) for p in negated))
+      self.assertEqual(len(edges['negation_in']), len(set(edges['negation_in'])))
+
+   def test_summary(self):
+      summary, attrs = graphdlv.summarize(self.graph, self.rules)
+      edges = dot_edges(summary, attrs)
+      self.assertTrue(edges['negation_in'])
+      self.assertEqual(len(edges['negation_in']), len(summary['negation_in']['edges']))
+      self.assertEqual(len(edges['negation_in']), len(set(edges['negation_in'])))
+
+   def test_partial_trace(self):
+      provenance = graphdlv.Negations(self.adj_list, self.adj_list.index)
+      trace = graphdlv.trace_all(provenance, self.adj_list.index.match('r'))
+      graph = graphdlv.pt_graph(trace)
+      edges = dot_edges(graph)
+      in_edges = [e for e in trace['edges'] | trace['back_edges'] if graphdlv.edge_pred(e) == 'negation_in']
+      self.assertTrue(in_edges)
+      self.assertEqual(len(edges['negation_in']), len(in_edges))
+
+   def test_old_store(self):
+      """ Stores that hold the in-edges of negation classes are migrated when opened. """
+      tmp = tempfile.mkdtemp()
+      try:
+         f_name = os.path.join(tmp, 'student.db')
+         storedlv.save(f_name, self.graph, self.adj_list, self.rules)
+         db = sqlite3.connect(f_name)
+         ids = dict((name, i) for i, name in db.execute('select id, name from atoms'))
+         rows = [('negation_in', ids[u], ids[v]) for u, v in graphdlv.negation_edges(self.graph)]
+         db.executemany('insert into edges values (?, ?, ?)', rows)
+         db.execute("insert into preds values ('negation_in')")
+         db.executescript('''create table old_nodes (pred text not null, atom integer not null);
+                             insert into old_nodes select pred, atom from nodes;
+                             drop table nodes;
+                             alter table old_nodes rename to nodes;
+                             create index nodes_pred on nodes(pred);
+                             pragma user_version = 0;''')
+         db.commit()
+         db.close()
+         graph, adj_list, rules = storedlv.load(f_name)
+         self.assertEqual(sorted(dot_edges(graph)['negation_in']), sorted(dot_edges(self.graph)['negation_in']))
+         self.assertEqual(adj_list.index.match('not se(a,_)'), self.adj_list.index.match('not se(a,_)'))
+         db = sqlite3.connect(f_name)
+         self.assertEqual(db.execute('pragma user_version').fetchone()[0], storedlv.version)
+         self.assertEqual(db.execute("select count(*) from edges where pred = 'negation_in'").fetchone()[0], 0)
+         db.close()
+      finally:
+         shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+   unittest.main()
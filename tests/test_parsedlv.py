@@ -0,0 +1,33 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import parsedlv
+
+class ParseTest(unittest.TestCase):
+   def test_parse(self):
+      rules, rule_map = parsedlv.parse('tc(X,Y) :- e(X,Z), tc(Z,Y).')
+      self.assertEqual([pred for pred, args in rule_map['aux_tc_0']], ['tc', 'e', 'tc'])
+      self.assertEqual(str(rules[0]).split('\n')[0].split(' :- ')[0], 'tc(X,Y)')
+      self.assertRaises(ValueError, parsedlv.parse, 'tc(X,Y) :- e(X,Y)')
+
+   def test_lextab_stale(self):
+      tmp = tempfile.mkdtemp()
+      try:
+         path = os.path.join(tmp, 'lextab.py')
+         self.assertFalse(parsedlv.lextab_stale(path))
+         text = open(parsedlv.lextab_path).read()
+         open(path, 'w').write(text)
+         self.assertFalse(parsedlv.lextab_stale(path))
+         open(path, 'w').write(text.replace(':-)', ':=)'))
+         self.assertTrue(parsedlv.lextab_stale(path))
+         open(path, 'w').write(text.replace("'RPAREN'", "'RBRACKET'"))
+         self.assertTrue(parsedlv.lextab_stale(path))
+      finally:
+         shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+   unittest.main()
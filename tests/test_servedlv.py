@@ -0,0 +1,94 @@
+import os
+import sys
+import json
+import urllib
+import urllib2
+import unittest
+import threading
+from distutils.spawn import find_executable
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import parsedlv
+import evaldlv
+import servedlv
+import gddb
+
+class ServerTest(unittest.TestCase):
+   @classmethod
+   def setUpClass(cls):
+      sample = os.path.join(root, 'sample_input')
+      rules, rule_map = parsedlv.parse(open(os.path.join(sample, 'tc-rules.dlv')).read())
+      facts = evaldlv.read_facts(os.path.join(sample, 'tc-facts.dlv'))
+      session = gddb.GraphCMD(rule_map, evaldlv.Evaluator(rules, facts).run())
+      cls.server = servedlv.Server(session, ('127.0.0.1', 0))
+      thread = threading.Thread(target=cls.server.serve_forever)
+      thread.daemon = True
+      thread.start()
+      cls.base = 'http://%s:%d' % cls.server.server_address[:2]
+
+   @classmethod
+   def tearDownClass(cls):
+      cls.server.shutdown()
+      cls.server.server_close()
+
+   def get(self, path, **query):
+      """ Returns the status, headers and body of GET path. """
+      url = self.base + path + ('?' + urllib.urlencode(query, True) if query else '')
+      try:
+         resp = urllib2.urlopen(url)
+      except urllib2.HTTPError as e:
+         return e.code, e.info(), e.read()
+      return resp.getcode(), resp.info(), resp.read()
+
+   def get_json(self, path, **query):
+      status, headers, body = self.get(path, **query)
+      self.assertEqual(headers['Content-Type'], 'application/json')
+      return status, json.loads(body)
+
+   def test_find(self):
+      status, found = self.get_json('/find', pattern='tc(1,_)')
+      self.assertEqual(status, 200)
+      self.assertEqual(found, {'atoms': ['tc(1,2)', 'tc(1,3)', 'tc(1,4)', 'tc(1,5)'], 'count': 4})
+      status, found = self.get_json('/find', pattern='tc(1,_)', limit='2')
+      self.assertEqual(found, {'atoms': ['tc(1,2)', 'tc(1,3)'], 'count': 4})
+
+   def test_count(self):
+      status, counts = self.get_json('/count', pattern=['tc(1,_)', 'e'])
+      self.assertEqual(status, 200)
+      self.assertEqual(counts['counts'], {'tc(1,_)': 4, 'e': 5})
+      status, counts = self.get_json('/count')
+      self.assertEqual(counts['counts']['e'], 5)
+      self.assertEqual(counts['counts']['tc'], 16)
+
+   def test_trace(self):
+      status, trace = self.get_json('/trace', atom='tc(1,2)')
+      self.assertEqual(status, 200)
+      self.assertIn('tc(1,2)', trace['nodes'])
+      self.assertIn('e(1,2)', trace['nodes'])
+      self.assertEqual(sorted(trace), ['back_edges', 'edges', 'nodes'])
+
+   def test_not_found(self):
+      self.assertEqual(self.get('/nope')[0], 404)
+      self.assertEqual(self.get('/trace', atom='tc(9,9)')[0], 404)
+
+   def test_bad_request(self):
+      self.assertEqual(self.get('/find', pattern='tc', limit='x')[0], 400)
+      self.assertEqual(self.get('/find')[0], 400)
+      self.assertEqual(self.get('/trace', atom='tc(1,2)', scc='1', witness='1')[0], 400)
+      self.assertEqual(self.get('/trace', atom='tc(1,2)', k='x')[0], 400)
+
+   def test_render(self):
+      status, headers, body = self.get('/render', atom='tc(1,2)')
+      if find_executable('dot') is None:
+         self.assertEqual(status, 500)
+         return
+      self.assertEqual(status, 200)
+      self.assertEqual(headers['Content-Type'], 'image/svg+xml')
+      self.assertEqual(headers['X-Cache'], 'miss')
+      status, headers, cached = self.get('/render', atom='tc(1,2)')
+      self.assertEqual(headers['X-Cache'], 'hit')
+      self.assertEqual(cached, body)
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,68 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import parsedlv
+import evaldlv
+import graphdlv
+import storedlv
+
+class StoredIndexTest(unittest.TestCase):
+   patterns = ['se(a,_)', 'se(X,1)', 'se', 'not se(a,_)', 'out(b)', 'out(z)', 'r(a)', '{se}', 'p(X)', 'nope(1)']
+
+   def setUp(self):
+      sample = os.path.join(root, 'sample_input')
+      rules, self.rules = parsedlv.parse(open(os.path.join(sample, 'student_rules.dlv')).read())
+      facts = evaldlv.read_facts(os.path.join(sample, 'student_facts.dlv'))
+      self.graph, self.adj_list = graphdlv.build(self.rules, evaldlv.Evaluator(rules, facts).run())
+      self.tmp = tempfile.mkdtemp()
+      self.f_name = os.path.join(self.tmp, 'student.db')
+      storedlv.save(self.f_name, self.graph, self.adj_list, self.rules)
+
+   def tearDown(self):
+      shutil.rmtree(self.tmp)
+
+   def test_match(self):
+      graph, adj_list, rules = storedlv.load(self.f_name)
+      index = adj_list.index
+      self.assertTrue(isinstance(index, storedlv.StoredIndex))
+      for pattern in self.patterns:
+         self.assertEqual(index.match(pattern), self.adj_list.index.match(pattern), pattern)
+         self.assertEqual(index.count(pattern), self.adj_list.index.count(pattern), pattern)
+      self.assertEqual(sorted(index.counts()), sorted(self.adj_list.index.counts()))
+
+   def test_ground_atoms(self):
+      graph, adj_list, rules = storedlv.load(self.f_name)
+      index = adj_list.index
+      self.assertEqual(index.match('r(a)'), ['r(a)'])
+      self.assertFalse(index.members.loaded(index.pred_ids['r']))
+      self.assertEqual(index.match('r(b)'), [])
+
+   def test_trace(self):
+      graph, adj_list, rules = storedlv.load(self.f_name)
+      for atom in ('late(c)', 'r(a)', 'out(b)'):
+         for precise in (None, self.rules):
+            stored = graphdlv.trace(graphdlv.Negations(adj_list, adj_list.index, precise), atom)
+            built = graphdlv.trace(graphdlv.Negations(self.adj_list, self.adj_list.index, precise), atom)
+            self.assertEqual(stored, built, atom)
+
+   def test_add_remove(self):
+      graph, adj_list, rules = storedlv.load(self.f_name)
+      index = adj_list.index
+      i = adj_list.atoms.ids['se(a,1)']
+      index.remove(i)
+      self.assertEqual(index.match('se(a,_)'), ['se(a,2)', 'se(a,3)'])
+      index.add(i)
+      self.assertEqual(index.match('se(a,_)'), ['se(a,1)', 'se(a,2)', 'se(a,3)'])
+      self.assertEqual(index.count('se'), self.adj_list.index.count('se'))
+      j = adj_list.atoms.ids['p(b)']
+      index.remove(j)
+      self.assertEqual(index.match('p(b)'), [])
+      self.assertEqual(index.count('p'), self.adj_list.index.count('p') - 1)
+
+if __name__ == '__main__':
+   unittest.main()